@@ -0,0 +1,318 @@
+import argparse, asyncio, io, json, os, random, subprocess, sys, time
+from datetime import datetime, timezone
+
+import boto3
+import httpx
+import psycopg
+from PIL import Image
+from psycopg import sql
+from psycopg.conninfo import make_conninfo
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main import backfill_user_interests, dumps_json, get_conninfo  # noqa: E402
+
+# Load test for the profile endpoints against a real Postgres and an S3 stand-in.
+#
+#   docker compose --profile bench up -d database s3
+#   python benchmarks/load_test.py --profiles 10000 --concurrency 32 --duration 60
+#
+# A fresh database (--database) is created and seeded with --profiles profiles,
+# the API is started with uvicorn against it (or --url points at a running one),
+# and --concurrency clients drive the --mix of operations for --duration seconds
+# after a --warmup. Throughput and p50/p95/p99 latencies per operation are
+# printed and written as JSON to --output; --compare takes an earlier results
+# file and prints the change against it. Everything random comes from --seed.
+
+OPERATIONS = ("get_user", "get_users_by_interest", "edit_user", "create_user")
+DEFAULT_MIX = "get_user=70,get_users_by_interest=15,edit_user=10,create_user=5"
+
+INTERESTS = [
+    "Dogs", "Cats", "Birds", "Fish", "Rabbits", "Hamsters", "Horses", "Reptiles",
+    "Adoption", "Training", "Grooming", "Walking", "Volunteering", "Fostering",
+]
+LOCALITIES = ["Aveiro", "Porto", "Lisboa", "Coimbra", "Braga", "Faro", "Viseu", "Leiria"]
+FIRST_NAMES = ["John", "Maria", "Ana", "Pedro", "Rita", "Tiago", "Sofia", "Miguel"]
+LAST_NAMES = ["Doe", "Silva", "Santos", "Ferreira", "Costa", "Oliveira", "Pereira"]
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        if name.strip() not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r}, expected one of {', '.join(OPERATIONS)}")
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+def make_profile(rng, i):
+    return {
+        "username": f"bench{i}",
+        "email": f"bench{i}@example.com",
+        "locality": rng.choice(LOCALITIES),
+        "first_name": rng.choice(FIRST_NAMES),
+        "last_name": rng.choice(LAST_NAMES),
+        "description": "Animal's lover. " * rng.randint(1, 8),
+        "interests": [{"interest": name} for name in rng.sample(INTERESTS, rng.randint(1, 4))],
+    }
+
+
+def png_image(rng, width=800, height=600):
+    data = io.BytesIO()
+    Image.new("RGB", (width, height), tuple(rng.randrange(256) for _ in range(3))).save(data, format="PNG")
+    return data.getvalue()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, duration):
+    latencies = sorted(latencies)
+    to_ms = lambda seconds: round(seconds * 1000, 2) if seconds is not None else None
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / duration, 1),
+        "mean_ms": to_ms(sum(latencies) / len(latencies)) if latencies else None,
+        "p50_ms": to_ms(percentile(latencies, 0.50)),
+        "p95_ms": to_ms(percentile(latencies, 0.95)),
+        "p99_ms": to_ms(percentile(latencies, 0.99)),
+        "max_ms": to_ms(latencies[-1]) if latencies else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Setup: database, bucket, server and seed data
+
+async def create_database(database):
+    async with await psycopg.AsyncConnection.connect(get_conninfo(), autocommit=True) as connection:
+        await connection.execute(sql.SQL("DROP DATABASE IF EXISTS {}").format(sql.Identifier(database)))
+        await connection.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(database)))
+
+
+# COPY straight into users_profile, then the same backfill the interests
+# migration runs on an existing database fills user_interests and the counters
+async def seed_profiles(database, profiles):
+    conninfo = make_conninfo(get_conninfo(), dbname=database)
+    async with await psycopg.AsyncConnection.connect(conninfo) as connection:
+        async with connection.cursor() as cursor:
+            copy_query = "COPY users_profile (username, email, locality, first_name, last_name, description, interests) FROM STDIN"
+            async with cursor.copy(copy_query) as copy:
+                for profile in profiles:
+                    await copy.write_row((
+                        profile["username"], profile["email"], profile["locality"], profile["first_name"],
+                        profile["last_name"], profile["description"], dumps_json(profile["interests"]),
+                    ))
+            await backfill_user_interests(cursor)
+            await cursor.execute("ANALYZE")
+        await connection.commit()
+
+
+def create_bucket(endpoint_url, bucket, region):
+    client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region,
+                          aws_access_key_id=os.getenv("ACCESS_KEY", "bench"), aws_secret_access_key=os.getenv("SECRET_KEY", "bench"))
+    try:
+        client.create_bucket(Bucket=bucket)
+    except client.exceptions.BucketAlreadyOwnedByYou:
+        pass
+
+
+def start_server(args):
+    env = dict(
+        os.environ,
+        DB_DATABASE=args.database,
+        BUCKET=args.bucket,
+        REGION=args.region,
+        S3_ENDPOINT_URL=args.s3_endpoint,
+        ACCESS_KEY=os.getenv("ACCESS_KEY", "bench"),
+        SECRET_KEY=os.getenv("SECRET_KEY", "bench"),
+    )
+    command = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(args.port),
+               "--workers", str(args.workers), "--log-level", "warning"]
+    return subprocess.Popen(command, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), env=env)
+
+
+# /ready rather than /health/: the API answers /health/ before it has migrated
+async def wait_until_ready(client, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/ready")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError(f"API not ready after {timeout}s")
+
+
+# Workload
+
+class Workload:
+    def __init__(self, args, profiles):
+        self.args = args
+        self.emails = [profile["email"] for profile in profiles]
+        self.operations = list(args.mix)
+        self.weights = [args.mix[name] for name in self.operations]
+        self.next_user = len(profiles)
+        self.image = png_image(random.Random(args.seed))
+        self.latencies = {name: [] for name in self.operations}
+        self.errors = {name: 0 for name in self.operations}
+        self.recording = False
+
+    def request(self, rng, operation):
+        if operation == "get_user":
+            return "GET", f"/profile/{rng.choice(self.emails)}", {}
+        if operation == "get_users_by_interest":
+            return "GET", f"/profile/users/{rng.choice(INTERESTS)}", {}
+        if operation == "edit_user":
+            profile = make_profile(rng, 0)
+            data = {
+                "locality": profile["locality"],
+                "first_name": profile["first_name"],
+                "last_name": profile["last_name"],
+                "description": profile["description"],
+                "interests": ",".join(item["interest"] for item in profile["interests"]),
+            }
+            files = {"image": ("Profile.png", self.image, "image/png")} if rng.random() < self.args.image_ratio else None
+            return "PUT", f"/profile/{rng.choice(self.emails)}", {"data": data, "files": files}
+        # create_user
+        self.next_user += 1
+        profile = make_profile(rng, self.next_user)
+        profile.pop("interests")
+        return "POST", "/profile/", {"data": profile}
+
+    async def client_loop(self, client, rng, stop_at):
+        while time.monotonic() < stop_at:
+            operation = rng.choices(self.operations, self.weights)[0]
+            method, url, kwargs = self.request(rng, operation)
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, url, **kwargs)
+                body = response.json() if response.headers.get("content-type", "").startswith("application/json") else None
+                # Errors come back as HTTPException bodies with a 200 status
+                failed = response.status_code >= 400 or (isinstance(body, dict) and body.get("status_code", 200) >= 400)
+            except httpx.HTTPError:
+                failed = True
+            elapsed = time.perf_counter() - start
+            if self.recording:
+                self.latencies[operation].append(elapsed)
+                self.errors[operation] += failed
+
+    async def run(self, client):
+        rngs = [random.Random(f"{self.args.seed}-{i}") for i in range(self.args.concurrency)]
+        stop_at = time.monotonic() + self.args.warmup + self.args.duration
+        tasks = [asyncio.create_task(self.client_loop(client, rng, stop_at)) for rng in rngs]
+        await asyncio.sleep(self.args.warmup)
+        self.recording = True
+        started = time.monotonic()
+        await asyncio.gather(*tasks)
+        return time.monotonic() - started
+
+
+def compare(results, baseline):
+    for operation, current in results["operations"].items():
+        previous = baseline.get("operations", {}).get(operation)
+        if not previous:
+            continue
+        changes = {}
+        for metric in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms"):
+            if current[metric] and previous[metric]:
+                changes[metric] = f"{(current[metric] - previous[metric]) / previous[metric] * 100:+.1f}%"
+        print(json.dumps({"operation": operation, "baseline_commit": baseline.get("commit"), **changes}))
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    profiles = [make_profile(rng, i) for i in range(args.profiles)]
+
+    server = None
+    if not args.url:
+        await create_database(args.database)
+        create_bucket(args.s3_endpoint, args.bucket, args.region)
+        server = start_server(args)
+    base_url = args.url or f"http://127.0.0.1:{args.port}"
+
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.timeout) as client:
+            await wait_until_ready(client, args.startup_timeout)
+            # The API migrates the database on startup, so seed once it's ready
+            if not args.url:
+                await seed_profiles(args.database, profiles)
+            workload = Workload(args, profiles)
+            duration = await workload.run(client)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    all_latencies = [latency for latencies in workload.latencies.values() for latency in latencies]
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            "profiles": args.profiles,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "warmup": args.warmup,
+            "workers": args.workers,
+            "mix": args.mix,
+            "image_ratio": args.image_ratio,
+            "seed": args.seed,
+        },
+        "operations": {
+            name: summarize(workload.latencies[name], workload.errors[name], duration)
+            for name in workload.operations
+        },
+        "total": summarize(all_latencies, sum(workload.errors.values()), duration),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the profile API against Postgres and an S3 stand-in")
+    parser.add_argument("--profiles", type=int, default=10000, help="profiles seeded before the run")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds run before measuring")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"operation weights, default {DEFAULT_MIX}")
+    parser.add_argument("--image-ratio", type=float, default=0.1, help="fraction of edit_user requests that upload an image")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--database", default="profile_bench", help="database created (and dropped first) for the run")
+    parser.add_argument("--bucket", default="profile-bench")
+    parser.add_argument("--region", default="us-east-1")
+    parser.add_argument("--s3-endpoint", default="http://localhost:5000", help="S3 stand-in, the compose s3 service by default")
+    parser.add_argument("--url", help="benchmark an already running API, whose database holds the profiles of an earlier run with the same --profiles and --seed")
+    parser.add_argument("--port", type=int, default=8011, help="port of the API started for the run")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers of the API started for the run")
+    parser.add_argument("--timeout", type=float, default=30, help="per request timeout in seconds")
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("--output", help="results file, default benchmarks/results/<commit>.json")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", f"{(results['commit'] or 'local')[:12]}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as results_file:
+        json.dump(results, results_file, indent=2)
+
+    for name, summary in {**results["operations"], "total": results["total"]}.items():
+        print(json.dumps({"operation": name, **summary}))
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare(results, json.load(baseline_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import argparse, json, os, sys, timeit
+from datetime import datetime, timezone
+from uuid import uuid4
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main import FastJSONResponse  # noqa: E402
+
+# Compares FastAPI's default path for a returned dict (jsonable_encoder followed
+# by JSONResponse) with returning a FastJSONResponse directly, on payloads shaped
+# like GET /profile/{email}, POST /profile/batch and GET /profile/users/{interest}.
+# Usage: python benchmarks/serialization.py [--repeat 5] [--number 200]
+
+
+def make_profile(i):
+    return {
+        "user_id": uuid4(),
+        "username": f"user{i}",
+        "email": f"user{i}@example.com",
+        "locality": "Aveiro",
+        "first_name": "John",
+        "last_name": "Doe",
+        "description": "Animal's lover. " * 8,
+        "interests": [{"interest": "Dogs"}, {"interest": "Cats"}, {"interest": "Birds"}],
+        "image": [f"https://bucket.s3.amazonaws.com/{uuid4()}_Profile.png"],
+        "image_variants": [{"thumbnail": "https://bucket.s3.amazonaws.com/thumbnail.jpg", "medium": "https://bucket.s3.amazonaws.com/medium.jpg"}],
+        "updated_at": datetime.now(timezone.utc),
+    }
+
+
+PAYLOADS = {
+    "profile": make_profile(0),
+    "batch_200": {"profiles": [make_profile(i) for i in range(200)], "missing": {"emails": [], "user_ids": []}},
+    "interest_500": [f"user{i}@example.com" for i in range(500)],
+}
+
+
+def default_path(payload):
+    return JSONResponse(jsonable_encoder(payload)).body
+
+
+def fast_path(payload):
+    return FastJSONResponse(payload).body
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark response serialization")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    results = []
+    for name, payload in PAYLOADS.items():
+        timings = {}
+        for path_name, path in (("default", default_path), ("fast", fast_path)):
+            best = min(timeit.repeat(lambda: path(payload), repeat=args.repeat, number=args.number))
+            timings[path_name] = best / args.number * 1_000_000
+        results.append({
+            "payload": name,
+            "default_us": round(timings["default"], 1),
+            "fast_us": round(timings["fast"], 1),
+            "speedup": round(timings["default"] / timings["fast"], 1),
+        })
+
+    for result in results:
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+import argparse, asyncio, json, sys
+import psycopg
+from main import get_conninfo, guess_import_format, import_profiles, IMPORT_FORMATS
+
+# Command line bulk import, for files too large to upload through POST /profile/import
+# Usage: python bulk_import.py profiles.csv [--format csv|ndjson]
+
+
+async def run_import(path, import_format):
+    async with await psycopg.AsyncConnection.connect(get_conninfo()) as connection:
+        with open(path, encoding="utf-8", newline="") as lines:
+            result = await import_profiles(connection, lines, import_format)
+        await connection.commit()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import users profiles from a CSV or NDJSON file")
+    parser.add_argument("path", help="CSV file with a header row, or NDJSON file with one profile per line")
+    parser.add_argument("--format", choices=IMPORT_FORMATS, help="defaults to ndjson for .ndjson/.jsonl files, csv otherwise")
+    args = parser.parse_args()
+
+    result = asyncio.run(run_import(args.path, args.format or guess_import_format(args.path)))
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
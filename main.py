@@ -1,29 +1,74 @@
-import boto3, psycopg2, os, logging
-from fastapi import FastAPI, Form, HTTPException, UploadFile, File, Query 
+import boto3, psycopg, os, logging, anyio
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from functools import partial
+from PIL import Image, ImageOps, UnidentifiedImageError
+from psycopg.conninfo import make_conninfo
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+from fastapi import FastAPI, Form, HTTPException, UploadFile, File, Query, Depends, Response, BackgroundTasks, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, JSONResponse
+from brotli_asgi import BrotliMiddleware
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Histogram, generate_latest, multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from pydantic import BaseModel
+from typing import Optional
 from dotenv import load_dotenv
 from uuid import UUID, uuid4
 import uuid
 import json
+import csv
+import io
+import tempfile
+import time
+import math
+import re
+import asyncio
+import itertools
+import random
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timedelta, timezone
+from psycopg.types.json import set_json_dumps, set_json_loads
 
-# FastAPI App Configuration
-app = FastAPI(debug=True)
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# orjson is a drop-in, much faster encoder; the stdlib json module is the fallback
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 load_dotenv()
 
+# Worker processes serving the app (serve.py sets it). The per-worker image
+# processing threads and DB pools default to one worker's share.
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+
 AWS_BUCKET = os.getenv("BUCKET")
 ACCESS_KEY = os.getenv("ACCESS_KEY")
 SECRET_KEY = os.getenv("SECRET_KEY")
 REGION = os.getenv("REGION")
+# Set to use an S3-compatible stand-in (moto, MinIO, LocalStack) instead of AWS
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
 
-s3 = boto3.client('s3', aws_access_key_id=ACCESS_KEY, aws_secret_access_key=SECRET_KEY, region_name=REGION)
+S3_MAX_CONCURRENT_TRANSFERS = int(os.getenv("S3_MAX_CONCURRENT_TRANSFERS", "8"))
+S3_MULTIPART_CHUNK_SIZE = int(os.getenv("S3_MULTIPART_CHUNK_SIZE", str(8 * 1024 * 1024)))
+
+# Profile image variants: name -> longest side in pixels (None keeps the original size)
+IMAGE_VARIANT_SIZES = {"thumbnail": 128, "medium": 640, "original": None}
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "82"))
+IMAGE_UPLOAD_CONTENT_TYPES = ("image/jpeg", "image/png", "image/webp", "image/gif")
+IMAGE_UPLOAD_MAX_BYTES = int(os.getenv("IMAGE_UPLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+IMAGE_UPLOAD_URL_EXPIRES = int(os.getenv("IMAGE_UPLOAD_URL_EXPIRES", "300"))
+# Larger images are rejected before they are decoded (decompression bombs)
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(40 * 1000 * 1000)))
+Image.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS
+IMAGE_PROCESSING_WORKERS = int(os.getenv("IMAGE_PROCESSING_WORKERS", str(max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY))))
+
+s3 = None
+s3_transfer_config = TransferConfig(multipart_threshold=S3_MULTIPART_CHUNK_SIZE, multipart_chunksize=S3_MULTIPART_CHUNK_SIZE)
+s3_limiter = anyio.CapacityLimiter(S3_MAX_CONCURRENT_TRANSFERS)
+image_processing_limiter = anyio.CapacityLimiter(IMAGE_PROCESSING_WORKERS)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -36,38 +81,640 @@ DB_HOST = os.getenv("DB_HOST")
 DB_PORT = os.getenv("DB_PORT")
 DB_DATABASE = os.getenv("DB_DATABASE")
 
-app = FastAPI()
+# Connections one container may open to each database server, split evenly
+# between its workers (0 leaves DB_POOL_MAX_SIZE at its default). Each worker
+# also holds a LISTEN connection, which comes out of its share.
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", "0"))
+
+def worker_pool_max_size(max_connections, workers):
+    return max(1, max_connections // workers - 1)
+
+# Connection pool sizing (per worker) and per-statement timeout
+DB_POOL_MAX_SIZE = int(os.getenv(
+    "DB_POOL_MAX_SIZE",
+    str(worker_pool_max_size(DB_MAX_CONNECTIONS, WEB_CONCURRENCY) if DB_MAX_CONNECTIONS else 10),
+))
+DB_POOL_MIN_SIZE = min(int(os.getenv("DB_POOL_MIN_SIZE", "2")), DB_POOL_MAX_SIZE)
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "600"))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "5000"))
+
+# Optional streaming replicas for read endpoints, as "host[:port],host[:port]".
+# They share the primary's credentials and database name.
+DB_REPLICA_HOSTS = [host.strip() for host in os.getenv("DB_REPLICA_HOSTS", "").split(",") if host.strip()]
+# Replicas further behind the primary than this many seconds are taken out of rotation
+DB_REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", "5"))
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", "2"))
+# Reads of a profile go to the primary for this long after it's written
+PRIMARY_PIN_SECONDS = float(os.getenv("PRIMARY_PIN_SECONDS", "10"))
+PRIMARY_PIN_MAX_SIZE = 10000
+
+# Zero when the replica has replayed up to the primary's WAL position (read
+# just before), otherwise the age of the last transaction it replayed. NULL,
+# so out of rotation, when it has no WAL receiver: it isn't connected to the
+# primary, and having replayed all it received says nothing about the primary.
+REPLICA_LAG_QUERY = """
+    SELECT CASE
+        WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver) THEN NULL
+        WHEN pg_last_wal_replay_lsn() >= %s::pg_lsn THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END::float8
+"""
+
+# Startup retries the database with exponential backoff (with jitter) up to this many seconds apart
+DB_CONNECT_BACKOFF_INITIAL = float(os.getenv("DB_CONNECT_BACKOFF_INITIAL", "0.5"))
+DB_CONNECT_BACKOFF_MAX = float(os.getenv("DB_CONNECT_BACKOFF_MAX", "30"))
+# Set to false when migrations run as a release step (python migrate.py) instead
+DB_MIGRATE_ON_STARTUP = os.getenv("DB_MIGRATE_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+# Held while migrating, so pods starting together don't migrate concurrently
+MIGRATIONS_LOCK_ID = 7209341
+
+pool = None
+db_ready = False
+replica_pools = []
+healthy_replica_pools = []
+primary_pins = {}
+replica_rotation = itertools.count()
+
+PROFILE_BATCH_MAX_SIZE = int(os.getenv("PROFILE_BATCH_MAX_SIZE", "200"))
+
+# Interest search paging
+INTEREST_PAGE_SIZE = int(os.getenv("INTEREST_PAGE_SIZE", "50"))
+INTEREST_PAGE_MAX_SIZE = int(os.getenv("INTEREST_PAGE_MAX_SIZE", "500"))
+INTEREST_MAX_TERMS = 20
+
+# Profile search paging
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "20"))
+SEARCH_PAGE_MAX_SIZE = int(os.getenv("SEARCH_PAGE_MAX_SIZE", "100"))
+SEARCH_MAX_OFFSET = int(os.getenv("SEARCH_MAX_OFFSET", "1000"))
+SEARCH_MAX_TERMS = 8
+
+# Proximity search: the bundled gazetteer that localities are geocoded
+# against (loaded into the localities table by the migrations), and the
+# radius and paging limits
+GAZETTEER_PATH = os.getenv("GAZETTEER_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "gazetteer.csv"))
+NEARBY_DEFAULT_RADIUS_KM = float(os.getenv("NEARBY_DEFAULT_RADIUS_KM", "25"))
+NEARBY_MAX_RADIUS_KM = float(os.getenv("NEARBY_MAX_RADIUS_KM", "500"))
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE_LATITUDE = 111.195
+
+# Bulk profile import
+IMPORT_FORMATS = ("csv", "ndjson")
+IMPORT_COLUMNS = ("username", "email", "locality", "first_name", "last_name", "description")
+# The COPY and the upsert are single statements that grow with the file, so
+# imports get their own statement timeout (0 = none) instead of the pool's
+IMPORT_STATEMENT_TIMEOUT_MS = int(os.getenv("IMPORT_STATEMENT_TIMEOUT_MS", "0"))
+
+# Streaming profile export
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))
+EXPORT_COLUMNS = ("user_id", "username", "email", "locality", "first_name", "last_name", "description", "interests", "image", "updated_at")
+
+# Profile columns plus the user's image URLs, filtered by {where}
+PROFILE_SELECT = """
+    SELECT p.user_id, p.username, p.email, p.locality, p.first_name,
+           p.last_name, p.description, p.interests, p.updated_at,
+           COALESCE(array_agg(i.image_url) FILTER (WHERE i.image_url IS NOT NULL), '{{}}') AS image,
+           COALESCE(jsonb_agg(i.variants) FILTER (WHERE i.variants IS NOT NULL), '[]') AS image_variants
+    FROM users_profile p
+    LEFT JOIN images i ON i.user_profile_id = p.user_id
+    WHERE {where}
+    GROUP BY p.user_id
+"""
+
+# Profile cache configuration (PROFILE_CACHE_MAX_SIZE=0 disables the cache)
+PROFILE_CACHE_MAX_SIZE = int(os.getenv("PROFILE_CACHE_MAX_SIZE", "10000"))
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "60"))
+PROFILE_CHANGES_CHANNEL = "profile_changed"
+
+# Change feed: page size, how long changes are kept, and how often a stream
+# with nothing to send rechecks the outbox (and sends a keepalive)
+PROFILE_CHANGES_PAGE_SIZE = int(os.getenv("PROFILE_CHANGES_PAGE_SIZE", "100"))
+PROFILE_CHANGES_PAGE_MAX_SIZE = int(os.getenv("PROFILE_CHANGES_PAGE_MAX_SIZE", "1000"))
+PROFILE_CHANGES_RETENTION = float(os.getenv("PROFILE_CHANGES_RETENTION", str(7 * 24 * 3600)))
+PROFILE_CHANGES_PRUNE_INTERVAL = float(os.getenv("PROFILE_CHANGES_PRUNE_INTERVAL", "3600"))
+PROFILE_CHANGES_STREAM_POLL_INTERVAL = float(os.getenv("PROFILE_CHANGES_STREAM_POLL_INTERVAL", "15"))
+
+# Statements slower than this are logged with their name (0 disables the log)
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "0"))
+
+# Sent with profile reads so clients and the CDN can cache and revalidate them
+PROFILE_CACHE_CONTROL = os.getenv("PROFILE_CACHE_CONTROL", "public, max-age=30, must-revalidate")
+
+
+# In-process LRU cache with a TTL for assembled profiles, keyed by email
+class ProfileCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        # Bumped on every invalidation, so a read that started before an
+        # invalidation can't put stale data back into the cache.
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def version(self):
+        return self._version
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            self.evictions += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, version):
+        if self.max_size <= 0 or version != self._version:
+            return
+
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self._version += 1
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._version += 1
+        self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+profile_cache = ProfileCache(PROFILE_CACHE_MAX_SIZE, PROFILE_CACHE_TTL)
+
+
+class ProfileBatchRequest(BaseModel):
+    emails: list[str] = []
+    user_ids: list[UUID] = []
+
+
+# Body of PATCH /profile/{email}; fields left out are not written
+class ProfilePatch(BaseModel):
+    locality: Optional[str] = None
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    description: Optional[str] = None
+    interests: Optional[list[str]] = None
+    add_interests: list[str] = []
+    remove_interests: list[str] = []
 
-@app.on_event("startup")
-async def startup_event():
-    while not connect_db():
-            continue
+PROFILE_PATCH_COLUMNS = ("locality", "first_name", "last_name", "description")
 
-# Database Connection
-def connect_db():
-    global connection, cursor
+
+# Response shapes, for the OpenAPI schema only: rows come straight from the
+# database, so the handlers return them without validating them again
+class UserProfile(BaseModel):
+    user_id: UUID
+    username: str
+    email: str
+    locality: Optional[str] = None
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    description: Optional[str] = None
+    interests: Optional[list[dict]] = None
+    image: list[str] = []
+    image_variants: list[dict] = []
+    updated_at: datetime
+
+
+class ProfileBatchMissing(BaseModel):
+    emails: list[str] = []
+    user_ids: list[UUID] = []
+
+
+class ProfileBatchResponse(BaseModel):
+    profiles: list[UserProfile]
+    missing: ProfileBatchMissing
+
+
+# The most recent changes, read once per worker by follow_profile_changes and
+# shared by all of the worker's change streams. Holds every change after start.
+class ProfileChangeTail:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.changes = deque()
+        self.start = None
+
+    def reset(self, position):
+        self.changes.clear()
+        self.start = position
+
+    def end(self):
+        return self.changes[-1][0] if self.changes else self.start
+
+    def extend(self, changes):
+        for change in changes:
+            self.changes.append((decode_change_cursor(change["cursor"]), change))
+        while len(self.changes) > self.max_size:
+            self.start = self.changes.popleft()[0]
+
+    # The changes after position, or None when the tail doesn't hold them all
+    def after(self, position):
+        if self.start is None or position < self.start:
+            return None
+        return [change for change_position, change in self.changes if change_position > position]
+
+
+startup_task = None
+profile_listener_task = None
+profile_changes_prune_task = None
+profile_changes_follow_task = None
+# Set by the listener on every change, wakes follow_profile_changes
+profile_changes_notified = None
+profile_change_tail = ProfileChangeTail(PROFILE_CHANGES_PAGE_MAX_SIZE)
+# One event per open change stream, set when the tail has new changes
+profile_change_waiters = set()
+replica_monitor_task = None
+
+# Metrics, exposed at /metrics
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time to send the response headers, by route template",
+    ["method", "route", "status"],
+)
+STAGE_LATENCY = Histogram(
+    "profile_stage_duration_seconds",
+    "Time spent in each stage of a request: db, s3, image or serialization",
+    ["stage", "name"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+
+# Times a stage of a request. Database statements slower than
+# SLOW_QUERY_THRESHOLD_MS are logged with their name.
+@contextmanager
+def observe_stage(stage, name):
+    start = time.perf_counter()
     try:
-        connection = psycopg2.connect(user=DB_USER, password=DB_PASSWORD, host=DB_HOST, port=DB_PORT, database=DB_DATABASE)
-
-        cursor = connection.cursor()
-        if connection:
-            cursor.execute("SELECT version();")
-            db_version = cursor.fetchone()
-            logger.info(f"Connected to {db_version[0]}")
-            create_tables()
-            return True
-        else:
-            logger.error("Failed to connect to the database.")
-            return False
-    except (Exception, psycopg2.Error) as error:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_LATENCY.labels(stage, name).observe(elapsed)
+        if stage == "db" and SLOW_QUERY_THRESHOLD_MS and elapsed * 1000 >= SLOW_QUERY_THRESHOLD_MS:
+            logger.warning(f"Slow query {name}: {elapsed * 1000:.1f} ms")
+
+# Pool saturation and cache effectiveness, read when /metrics is scraped
+class ProfileMetricsCollector:
+    POOL_STATS = ("pool_min", "pool_max", "pool_size", "pool_available", "requests_waiting")
+
+    def collect(self):
+        pool_gauges = {
+            stat: GaugeMetricFamily(f"db_{stat}", f"Connection pool {stat.replace('_', ' ')}", labels=["pool"])
+            for stat in self.POOL_STATS
+        }
+        for db_pool in [pool, *replica_pools]:
+            if db_pool is None:
+                continue
+            stats = db_pool.get_stats()
+            for stat, gauge in pool_gauges.items():
+                gauge.add_metric([db_pool.name], stats.get(stat, 0))
+        yield from pool_gauges.values()
+
+        healthy = GaugeMetricFamily("db_replicas_healthy", "Replicas in the read rotation")
+        healthy.add_metric([], len(healthy_replica_pools))
+        yield healthy
+
+        stats = profile_cache.stats()
+        yield GaugeMetricFamily("profile_cache_size", "Profiles in the cache", value=stats["size"])
+        yield GaugeMetricFamily("profile_cache_hit_ratio", "Profile cache hits over lookups", value=stats["hit_ratio"])
+        for counter in ("hits", "misses", "evictions"):
+            yield CounterMetricFamily(f"profile_cache_{counter}", f"Profile cache {counter}", value=stats[counter])
+
+# With several workers (serve.py sets PROMETHEUS_MULTIPROC_DIR) each one writes
+# its histograms to that directory and /metrics adds them all up. The pool and
+# cache gauges are those of the worker answering the scrape.
+if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+    METRICS_REGISTRY = CollectorRegistry()
+    multiprocess.MultiProcessCollector(METRICS_REGISTRY)
+else:
+    METRICS_REGISTRY = REGISTRY
+METRICS_REGISTRY.register(ProfileMetricsCollector())
+
+# Latency per route template rather than per path, so emails don't become labels
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                route = scope.get("route")
+                REQUEST_LATENCY.labels(
+                    scope["method"], route.path if route else "unmatched", status
+                ).observe(time.perf_counter() - start)
+            await send(message)
+
+        await self.app(scope, receive, send_with_status)
+
+# JSON encoding for responses, JSONB parameters and the export stream
+def dumps_json(value):
+    if orjson is not None:
+        return orjson.dumps(value, default=str).decode()
+    return json.dumps(value, default=str)
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content):
+        with observe_stage("serialization", "json"):
+            if orjson is not None:
+                return orjson.dumps(content, default=str)
+            return super().render(content)
+
+if orjson is not None:
+    set_json_dumps(orjson.dumps)
+    set_json_loads(orjson.loads)
+
+# Responses above this many bytes are sent brotli or gzip compressed,
+# whichever the client accepts
+COMPRESSION_MINIMUM_SIZE = int(os.getenv("COMPRESSION_MINIMUM_SIZE", "1024"))
+
+# Per-worker state: each worker opens its own pools, LISTEN connection and
+# background tasks when it starts and closes them when it stops. Nothing is
+# opened at import time, so nothing is shared by workers forked from one parent.
+# The database is connected in the background, so the process answers /health/
+# right away; /ready tells when it can take traffic.
+@asynccontextmanager
+async def lifespan(app):
+    global startup_task
+    startup_task = asyncio.create_task(start_db())
+    try:
+        yield
+    finally:
+        await stop_db()
+
+# FastAPI App Configuration
+app = FastAPI(default_response_class=FastJSONResponse, lifespan=lifespan)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+# Server-sent events go out as they happen, so the change stream isn't compressed
+app.add_middleware(
+    BrotliMiddleware,
+    minimum_size=COMPRESSION_MINIMUM_SIZE,
+    gzip_fallback=True,
+    excluded_handlers=["^/profile/changes/stream$"],
+)
+app.add_middleware(MetricsMiddleware)
+
+async def start_db():
+    global db_ready, profile_listener_task, profile_changes_prune_task, profile_changes_follow_task, profile_changes_notified, replica_monitor_task
+    delay = DB_CONNECT_BACKOFF_INITIAL
+    while not await connect_db():
+        retry_in = random.uniform(delay / 2, delay)
+        logger.info(f"Retrying the database connection in {retry_in:.1f}s")
+        await asyncio.sleep(retry_in)
+        delay = min(delay * 2, DB_CONNECT_BACKOFF_MAX)
+    profile_changes_notified = asyncio.Event()
+    profile_listener_task = asyncio.create_task(listen_for_profile_changes())
+    profile_changes_prune_task = asyncio.create_task(prune_profile_changes())
+    profile_changes_follow_task = asyncio.create_task(follow_profile_changes())
+    if DB_REPLICA_HOSTS:
+        await connect_replicas()
+        replica_monitor_task = asyncio.create_task(monitor_replicas())
+    db_ready = True
+
+async def stop_db():
+    if startup_task is not None:
+        startup_task.cancel()
+    if profile_listener_task is not None:
+        profile_listener_task.cancel()
+    if profile_changes_prune_task is not None:
+        profile_changes_prune_task.cancel()
+    if profile_changes_follow_task is not None:
+        profile_changes_follow_task.cancel()
+    if replica_monitor_task is not None:
+        replica_monitor_task.cancel()
+    for replica_pool in replica_pools:
+        await replica_pool.close()
+    if pool is not None:
+        await pool.close()
+
+def get_conninfo(host=None, port=None):
+    return make_conninfo(user=DB_USER, password=DB_PASSWORD, host=host or DB_HOST, port=port or DB_PORT, dbname=DB_DATABASE)
+
+def create_pool(conninfo, name):
+    return AsyncConnectionPool(
+        conninfo,
+        name=name,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        timeout=DB_POOL_TIMEOUT,
+        max_idle=DB_POOL_MAX_IDLE,
+        # Every connection gets a server-side statement timeout so a slow
+        # query fails fast instead of pinning a pooled connection.
+        kwargs={"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"},
+        # Broken connections are detected on checkout and replaced.
+        check=AsyncConnectionPool.check_connection,
+        open=False,
+    )
+
+# Database Connection Pool
+async def connect_db():
+    global pool
+    try:
+        pool = create_pool(get_conninfo(), "primary")
+        await pool.open(wait=True, timeout=DB_POOL_TIMEOUT)
+
+        async with pool.connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute("SELECT version();")
+                db_version = await cursor.fetchone()
+                logger.info(f"Connected to {db_version[0]}")
+            if DB_MIGRATE_ON_STARTUP:
+                await migrate(connection)
+        return True
+    except (Exception, psycopg.Error) as error:
         logger.error(f"Error while connecting to PostgreSQL: {error}")
+        if pool is not None:
+            await pool.close()
+            pool = None
         return False
+
+# Invalidates this worker's cached profiles when any worker commits a change,
+# pins the profile to the primary and wakes this worker's change reader.
+# Uses a dedicated connection, since a LISTEN session can't go back to the pool.
+async def listen_for_profile_changes():
+    conninfo = get_conninfo()
+    while True:
+        try:
+            async with await psycopg.AsyncConnection.connect(conninfo, autocommit=True) as connection:
+                await connection.execute(f"LISTEN {PROFILE_CHANGES_CHANNEL}")
+                # Anything may have changed while we weren't listening
+                profile_cache.clear()
+                async for notify in connection.notifies():
+                    if notify.payload:
+                        change = json.loads(notify.payload)
+                        profile_cache.invalidate(change["email"])
+                        pin_to_primary(change["email"], change["user_id"])
+                    profile_changes_notified.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            logger.error(f"Profile change listener disconnected: {error}")
+            profile_cache.clear()
+            await asyncio.sleep(1)
+
+# Replica pools open in the background; a replica only joins the rotation
+# once the monitor has seen it reachable and caught up.
+async def connect_replicas():
+    for replica_host in DB_REPLICA_HOSTS:
+        host, _, port = replica_host.partition(":")
+        replica_pool = create_pool(get_conninfo(host, port), f"replica-{replica_host}")
+        await replica_pool.open(wait=False)
+        replica_pools.append(replica_pool)
+
+async def monitor_replicas():
+    while True:
+        primary_lsn = await get_primary_lsn()
+        for replica_pool in replica_pools:
+            await check_replica(replica_pool, primary_lsn)
+        await asyncio.sleep(DB_REPLICA_CHECK_INTERVAL)
+
+# None when the primary can't be reached; replicas are then judged on the age
+# of what they last replayed
+async def get_primary_lsn():
+    try:
+        async with read_connection(pool, timeout=DB_REPLICA_CHECK_INTERVAL) as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute("SELECT pg_current_wal_lsn()::text")
+                return (await cursor.fetchone())[0]
+    except Exception as error:
+        logger.warning(f"Primary WAL position unavailable: {error}")
+        return None
+
+async def check_replica(replica_pool, primary_lsn):
+    try:
+        async with read_connection(replica_pool, timeout=DB_REPLICA_CHECK_INTERVAL) as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(REPLICA_LAG_QUERY, (primary_lsn,))
+                lag = (await cursor.fetchone())[0]
+    except Exception as error:
+        logger.warning(f"Replica {replica_pool.name} unavailable: {error}")
+        lag = None
+
+    healthy = lag is not None and lag <= DB_REPLICA_MAX_LAG
+    if healthy and replica_pool not in healthy_replica_pools:
+        logger.info(f"Replica {replica_pool.name} back in rotation")
+        healthy_replica_pools.append(replica_pool)
+    elif not healthy and replica_pool in healthy_replica_pools:
+        logger.warning(f"Replica {replica_pool.name} out of rotation, lag {lag}")
+        healthy_replica_pools.remove(replica_pool)
+    return healthy
+
+# Writers read their own writes: a changed profile is served from the primary
+# until the replicas have had time to catch up. Pinned by both email and
+# user_id, since reads look profiles up by either.
+def pin_to_primary(email, user_id):
+    now = time.monotonic()
+    if len(primary_pins) >= PRIMARY_PIN_MAX_SIZE:
+        for pinned_key, pinned_until in list(primary_pins.items()):
+            if pinned_until <= now:
+                del primary_pins[pinned_key]
+    primary_pins[email] = now + PRIMARY_PIN_SECONDS
+    primary_pins[str(user_id)] = now + PRIMARY_PIN_SECONDS
+
+def is_pinned_to_primary(key):
+    pinned_until = primary_pins.get(key)
+    if pinned_until is None:
+        return False
+    if pinned_until <= time.monotonic():
+        primary_pins.pop(key, None)
+        return False
+    return True
+
+# Pool for a read-only query, round robin over the healthy replicas. Falls back
+# to the primary when there are none, or when any of the profiles read (by
+# email or user_id) was just written.
+def get_read_pool(keys=()):
+    if not healthy_replica_pools or any(is_pinned_to_primary(str(key)) for key in keys):
+        return pool
+    return healthy_replica_pools[next(replica_rotation) % len(healthy_replica_pools)]
+
+# Per-request connection checkout; the connection goes back to the pool
+# once the request is finished.
+async def get_db_connection():
+    if pool is None:
+        raise HTTPException(status_code=503, detail="Database not ready")
+    async with pool.connection() as connection:
+        yield connection
+
+async def get_read_db_connection():
+    if pool is None:
+        raise HTTPException(status_code=503, detail="Database not ready")
+    async with read_connection(get_read_pool()) as connection:
+        yield connection
+
+# Checkout for read-only queries. In autocommit each query ends its own
+# transaction, so the connection goes back to the pool idle instead of
+# costing the pool a rollback round trip.
+@asynccontextmanager
+async def read_connection(db_pool, **kwargs):
+    async with db_pool.connection(**kwargs) as connection:
+        await connection.set_autocommit(True)
+        try:
+            yield connection
+        finally:
+            await connection.set_autocommit(False)
+
+# boto3 clients are slow to build, so the S3 client is only built on first use
+def get_s3():
+    global s3
+    if s3 is None:
+        s3 = boto3.client('s3', aws_access_key_id=ACCESS_KEY, aws_secret_access_key=SECRET_KEY, region_name=REGION, endpoint_url=S3_ENDPOINT_URL)
+    return s3
     
     
+# Liveness: answers as long as the process does, without touching the database
 @app.get("/health/")
 async def health():
     return HTTPException(status_code=200, detail="Server is healthy")
 
+# Readiness: the database is connected and migrated
+@app.get("/ready")
+async def ready():
+    if not db_ready:
+        return FastJSONResponse({"status_code": 503, "detail": "Database not ready"}, status_code=503)
+    return HTTPException(status_code=200, detail="Server is ready")
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(generate_latest(METRICS_REGISTRY), media_type=CONTENT_TYPE_LATEST)
+
 
 #Create users profile
 @app.post("/profile/")
@@ -77,27 +724,31 @@ async def create_user(
     locality: str = Form(None),
     first_name: str = Form(None),
     last_name: str = Form(None),
-    description: str = Form(None)
+    description: str = Form(None),
+    connection = Depends(get_db_connection)
 ):
-    global connection
     try:
-        with connection.cursor() as cursor:
+        async with connection.cursor() as cursor:
             
-            check_query = "SELECT * FROM users_profile WHERE email = %s"
-            cursor.execute(check_query, (email,))
-            existing_user = cursor.fetchone()
+            # A single INSERT ... ON CONFLICT, so concurrent signups for the
+            # same email can't race between a check and the insert
+            with observe_stage("db", "insert_profile"):
+                new_user = await insert_user_profile_data(cursor,username,email,locality,first_name,last_name,description)
             
-            if existing_user:
+            if not new_user:
+                await connection.rollback()
                 return HTTPException(status_code=400, detail="User already exists")
                  
-            insert_user_profile_data(cursor,username,email,locality,first_name,last_name,description)
+            await record_profile_change(cursor, new_user[0], email, "created")
             
-            connection.commit()
+            await connection.commit()
+            profile_cache.invalidate(email)
+            pin_to_primary(email, new_user[0])
 
             return {"message": "User Profile created successfully!"}
     
     except Exception as e:
-        connection.rollback()
+        await connection.rollback()
         logger.error(f"Error adding profile: {e}")
         return HTTPException(status_code=500, detail="Internal Server Error")
 
@@ -111,149 +762,762 @@ async def edit_user(
     description: str = Form(None),
     #interests: list[str] = Form(None),
     interests: str = Form(None),
-    image: UploadFile = Form(None)
+    image: UploadFile = Form(None),
 ):
-    
-    global connection
-    try:
-        with connection.cursor() as cursor:
+    if pool is None:
+        raise HTTPException(status_code=503, detail="Database not ready")
+
+    # Resize and upload first; the connection is only checked out afterwards,
+    # so image work never holds one of the pool's connections
+    uploaded_image = None
+    if image:
+        if image.size is not None and image.size > IMAGE_UPLOAD_MAX_BYTES:
+            return HTTPException(status_code=413, detail=f"Image exceeds the maximum size of {IMAGE_UPLOAD_MAX_BYTES} bytes")
+        try:
+            uploaded_image = await upload_image_to_s3(image)
+        except (UnidentifiedImageError, Image.DecompressionBombError):
+            return HTTPException(status_code=400, detail="Invalid image")
+        except Exception as e:
+            logger.error(f"Error uploading image: {e}")
+            return HTTPException(status_code=500, detail="Internal Server Error")
+
+    async with pool.connection() as connection:
+        try:
+            async with connection.cursor(row_factory=dict_row) as cursor:
             
-            check_query = "SELECT * FROM users_profile WHERE email = %s"
-            cursor.execute(check_query, (email,))
-            existing_user = cursor.fetchone()
+                # Convert comma-separated interests to an array of JSON objects
+                interests_list = []
+                if interests:
+                    for interest in interests.split(','):   
+                        interests_list.append({"interest": interest.strip()})   
             
-            if not existing_user:
-                return HTTPException(status_code=404, detail="User not found")
+                # Existence check and update in one statement; the previous
+                # locality is returned for the interest facet counters
+                update_query = """
+                    WITH previous AS (
+                        SELECT user_id, locality FROM users_profile WHERE email = %s FOR UPDATE
+                    )
+                    UPDATE users_profile p
+                    SET locality = %s,
+                        first_name = %s,
+                        last_name = %s,
+                        description = %s,
+                        interests = %s::jsonb,
+                        updated_at = now(),
+                        change_txid = pg_current_xact_id()
+                    FROM previous
+                    WHERE p.user_id = previous.user_id
+                    RETURNING p.user_id, previous.locality AS previous_locality
+                """
             
-            # Convert comma-separated interests to an array of JSON objects
-            interests_list = []
-            if interests:
-                for interest in interests.split(','):   
-                    interests_list.append({"interest": interest.strip()})   
+                with observe_stage("db", "update_profile"):
+                    await cursor.execute(
+                        update_query,
+                        (email, locality, first_name, last_name, description, dumps_json(interests_list)),
+                        prepare=True,
+                    )
+                    existing_user = await cursor.fetchone()
             
-            update_query = """
-                UPDATE users_profile 
-                SET locality = %s,
-                    first_name = %s,
-                    last_name = %s,
-                    description = %s,
-                    interests = %s::jsonb
-                WHERE email = %s
-            """
+                if not existing_user:
+                    await connection.rollback()
+                    if uploaded_image:
+                        await delete_images_from_s3(uploaded_image[0])
+                    return HTTPException(status_code=404, detail="User not found")
+
+                user_id = str(existing_user["user_id"])
+                with observe_stage("db", "sync_interests"):
+                    await sync_user_interests(
+                        connection,
+                        user_id,
+                        existing_user["previous_locality"],
+                        locality,
+                        [item["interest"] for item in interests_list],
+                    )
             
-            cursor.execute(
-                update_query,
-                (locality, first_name, last_name, description, json.dumps(interests_list), email),
+                if uploaded_image:
+                    object_keys, image_url, variants = uploaded_image
+                    logger.info(f"Saving image: {image}")
+                    with observe_stage("db", "upsert_image"):
+                        await upsert_image_data(cursor, image.filename, image_url, variants, user_id)
+
+                await record_profile_change(cursor, user_id, email, "updated")
+                with observe_stage("db", "commit"):
+                    await connection.commit()
+                profile_cache.invalidate(email)
+                pin_to_primary(email, user_id)
+
+                return {"message": "User Profile updated successfully!"}
+
+        except Exception as e:
+            await connection.rollback()
+            # The image row was never committed, so the uploaded object is orphaned
+            if uploaded_image:
+                await delete_images_from_s3(uploaded_image[0])
+            logger.error(f"Error updating user: {e}")
+            return HTTPException(status_code=500, detail="Internal Server Error")
+    
+#Partially update user's profile: only the fields present in the body are
+#written (null clears one). Interests can be replaced as a whole, or changed
+#with add_interests/remove_interests. With If-Match, the update only applies
+#to that version of the profile (412 otherwise). The new version is returned
+#in the ETag header.
+@app.patch("/profile/{email}")
+async def patch_user(
+    email: str,
+    changes: ProfilePatch,
+    request: Request,
+    connection = Depends(get_db_connection)
+):
+    fields = changes.model_fields_set
+    if "interests" in fields and (changes.add_interests or changes.remove_interests):
+        return HTTPException(status_code=400, detail="interests can't be combined with add_interests or remove_interests")
+
+    expected_version = None
+    if_match = request.headers.get("if-match")
+    if if_match and if_match.strip() != "*":
+        expected_version = etag_version(if_match)
+        if expected_version is None:
+            return HTTPException(status_code=412, detail="Profile has changed")
+
+    set_clauses = []
+    params = []
+    for column in PROFILE_PATCH_COLUMNS:
+        if column in fields:
+            set_clauses.append(f"{column} = %s")
+            params.append(getattr(changes, column))
+
+    interests_changed = "interests" in fields or changes.add_interests or changes.remove_interests
+    if interests_changed:
+        # The stored set (or the replacement) minus the removed names, then the
+        # added names it doesn't have yet, in order
+        current = "%s::jsonb" if "interests" in fields else "COALESCE(p.interests, '[]'::jsonb)"
+        if "interests" in fields:
+            params.append(dumps_json([{"interest": name} for name in clean_interest_names(changes.interests or [])]))
+        set_clauses.append(f"""interests = (
+            SELECT COALESCE(jsonb_agg(item ORDER BY position), '[]'::jsonb)
+            FROM (
+                SELECT item, position
+                FROM jsonb_array_elements({current}) WITH ORDINALITY AS kept(item, position)
+                WHERE NOT (item->>'interest' = ANY(%s::text[]))
+                UNION ALL
+                SELECT jsonb_build_object('interest', name), 1000000 + position
+                FROM unnest(%s::text[]) WITH ORDINALITY AS added(name, position)
+                WHERE NOT ({current} @> jsonb_build_array(jsonb_build_object('interest', name)))
+            ) AS merged
+        )""")
+        remove_names = clean_interest_names(changes.remove_interests)
+        add_names = [name for name in clean_interest_names(changes.add_interests) if name not in remove_names]
+        params.append(remove_names)
+        params.append(add_names)
+        if "interests" in fields:
+            params.append(params[-3])
+
+    if not set_clauses:
+        return HTTPException(status_code=400, detail="No fields to update")
+
+    # One statement: lock, version check and write of only the supplied columns
+    update_query = f"""
+        WITH previous AS (
+            SELECT user_id, locality, updated_at FROM users_profile WHERE email = %s FOR UPDATE
+        ),
+        updated AS (
+            UPDATE users_profile p
+            SET {", ".join(set_clauses)},
+                updated_at = now(),
+                change_txid = pg_current_xact_id()
+            FROM previous
+            WHERE p.user_id = previous.user_id
+              AND (%s::timestamptz IS NULL OR previous.updated_at = %s::timestamptz)
+            RETURNING p.user_id, p.locality, p.interests, p.updated_at, previous.locality AS previous_locality
+        )
+        SELECT EXISTS (SELECT 1 FROM previous) AS found, u.*
+        FROM (SELECT 1) AS one LEFT JOIN updated u ON true
+    """
+
+    try:
+        async with connection.cursor(row_factory=dict_row) as cursor:
+            with observe_stage("db", "patch_profile"):
+                await cursor.execute(update_query, (email, *params, expected_version, expected_version))
+                result = await cursor.fetchone()
+
+            if not result["found"]:
+                await connection.rollback()
+                return HTTPException(status_code=404, detail="User not found")
+            if result["user_id"] is None:
+                await connection.rollback()
+                return HTTPException(status_code=412, detail="Profile has changed")
+
+            user_id = str(result["user_id"])
+            if interests_changed or "locality" in fields:
+                with observe_stage("db", "sync_interests"):
+                    await sync_user_interests(
+                        connection,
+                        user_id,
+                        result["previous_locality"],
+                        result["locality"],
+                        [item["interest"] for item in result["interests"] or []],
+                    )
+
+            await record_profile_change(cursor, user_id, email, "updated")
+            await connection.commit()
+            profile_cache.invalidate(email)
+            pin_to_primary(email, user_id)
+
+            etag = profile_etag(result["updated_at"])
+            return FastJSONResponse(
+                {"message": "User Profile updated successfully!", "updated_at": result["updated_at"]},
+                headers={"ETag": etag},
             )
-            
-            if image:
-                # Check if there are existing images for the user_id
-                select_images_query = "SELECT * FROM images WHERE user_profile_id = %s"
-                cursor.execute(select_images_query, (str(existing_user[0]),))
-                existing_images = cursor.fetchall()
-                
-                if existing_images:
-                    logger.info("Update existing image")
-                    image_url = upload_image_to_s3(image)
-                    update_image_data(cursor, image.filename, image_url, str(existing_user[0]))
-                else:
-                    logger.info(f"Inserting image: {image}")
-                    image_url = upload_image_to_s3(image)
-                    insert_image_data(cursor, image.filename, image_url, str(existing_user[0]))
-
-            connection.commit()
-
-            return {"message": "User Profile updated successfully!"}
 
     except Exception as e:
-        connection.rollback()
-        logger.error(f"Error updating user: {e}")
+        await connection.rollback()
+        logger.error(f"Error patching user: {e}")
         return HTTPException(status_code=500, detail="Internal Server Error")
-    
+
+# Declared before /profile/{email} so "search" and "export" aren't taken for an email
+#Search users by name, username and description, best matches first.
+#Every word is prefix matched, and the username is also fuzzy matched so typos
+#still find it. Results can be narrowed to a locality and/or an interest; when
+#there are more, the offset of the next page is sent in X-Next-Offset.
+@app.get("/profile/search")
+async def search_users(
+    q: str = Query(..., min_length=1, max_length=200),
+    locality: str = Query(None),
+    interest: str = Query(None),
+    limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=SEARCH_PAGE_MAX_SIZE),
+    offset: int = Query(0, ge=0, le=SEARCH_MAX_OFFSET),
+    connection = Depends(get_read_db_connection)
+):
+    words = re.findall(r"\w+", q.lower())[:SEARCH_MAX_TERMS]
+    if not words:
+        return FastJSONResponse([])
+    text_query = " & ".join(f"{word}:*" for word in words)
+
+    filters = ""
+    params = [q.lower(), text_query, q.lower()]
+    if locality:
+        filters += " AND p.locality = %s"
+        params.append(locality)
+    if interest:
+        filters += " AND p.interests @> %s::jsonb"
+        params.append(dumps_json([{"interest": interest}]))
+    # One extra row tells us whether there is a next page
+    params.extend([limit + 1, offset])
+
+    select_query = f"""
+        SELECT p.user_id, p.username, p.email, p.locality, p.first_name, p.last_name,
+               ts_rank_cd(p.search_vector, query) + similarity(lower(p.username), %s) AS rank
+        FROM users_profile p, to_tsquery('simple', %s) AS query
+        WHERE (p.search_vector @@ query OR lower(p.username) %% %s){filters}
+        ORDER BY rank DESC, p.user_id
+        LIMIT %s OFFSET %s
+    """
+
+    try:
+        async with connection.cursor(row_factory=dict_row) as cursor:
+            with observe_stage("db", "search_profiles"):
+                await cursor.execute(select_query, params, prepare=True)
+                results = await cursor.fetchall()
+
+            headers = {"X-Next-Offset": str(offset + limit)} if len(results) > limit else None
+
+            return FastJSONResponse(results[:limit], headers=headers)
+
+    except Exception as e:
+        logger.error(f"Error searching users: {e}")
+        return HTTPException(status_code=500, detail="Internal Server Error")
+
+#Users within radius_km of a locality (or of latitude/longitude), nearest
+#first, optionally with an interest. Profiles are geocoded when their locality
+#is written, so this is an indexed bounding box lookup plus the exact distance
+#of the few rows inside it. When there are more, the offset of the next page
+#is sent in X-Next-Offset.
+@app.get("/profile/nearby")
+async def get_nearby_users(
+    locality: str = Query(None),
+    latitude: float = Query(None, ge=-90, le=90),
+    longitude: float = Query(None, ge=-180, le=180),
+    radius_km: float = Query(NEARBY_DEFAULT_RADIUS_KM, gt=0, le=NEARBY_MAX_RADIUS_KM),
+    interest: str = Query(None),
+    limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=SEARCH_PAGE_MAX_SIZE),
+    offset: int = Query(0, ge=0, le=SEARCH_MAX_OFFSET),
+    connection = Depends(get_read_db_connection)
+):
+    if locality:
+        origin = geocode_locality(locality)
+        if origin is None:
+            return HTTPException(status_code=400, detail="Unknown locality")
+    elif latitude is not None and longitude is not None:
+        origin = (latitude, longitude)
+    else:
+        return HTTPException(status_code=400, detail="locality or latitude and longitude are required")
+
+    latitude, longitude = origin
+    min_longitude, min_latitude, max_longitude, max_latitude = bounding_box(latitude, longitude, radius_km)
+
+    filters = ""
+    params = [latitude, latitude, longitude, min_longitude, min_latitude, max_longitude, max_latitude]
+    if interest:
+        filters += " AND p.interests @> %s::jsonb"
+        params.append(dumps_json([{"interest": interest}]))
+    # One extra row tells us whether there is a next page
+    params.extend([radius_km, limit + 1, offset])
+
+    # location is point(longitude, latitude); the box is the GiST index scan,
+    # the haversine distance only runs for the rows inside it
+    select_query = f"""
+        SELECT user_id, username, email, locality, first_name, last_name, distance_km
+        FROM (
+            SELECT p.user_id, p.username, p.email, p.locality, p.first_name, p.last_name,
+                   2 * {EARTH_RADIUS_KM} * asin(sqrt(
+                       power(sin(radians(p.location[1] - %s) / 2), 2) +
+                       cos(radians(%s)) * cos(radians(p.location[1])) *
+                       power(sin(radians(p.location[0] - %s) / 2), 2)
+                   )) AS distance_km
+            FROM users_profile p
+            WHERE p.location <@ box(point(%s, %s), point(%s, %s)){filters}
+        ) AS nearby
+        WHERE distance_km <= %s
+        ORDER BY distance_km, user_id
+        LIMIT %s OFFSET %s
+    """
+
+    try:
+        async with connection.cursor(row_factory=dict_row) as cursor:
+            with observe_stage("db", "nearby_profiles"):
+                await cursor.execute(select_query, params, prepare=True)
+                results = await cursor.fetchall()
+
+            headers = {"X-Next-Offset": str(offset + limit)} if len(results) > limit else None
+
+            return FastJSONResponse(results[:limit], headers=headers)
+
+    except Exception as e:
+        logger.error(f"Error retrieving nearby users: {e}")
+        return HTTPException(status_code=500, detail="Internal Server Error")
+
+#Profile changes (created, updated, image_updated) after the since= cursor,
+#oldest first, so other services can follow profiles without polling them.
+#Each change carries its cursor; the one to continue from is sent in X-Next-Cursor.
+@app.get("/profile/changes")
+async def get_profile_changes(
+    since: str = Query(None),
+    limit: int = Query(PROFILE_CHANGES_PAGE_SIZE, ge=1, le=PROFILE_CHANGES_PAGE_MAX_SIZE),
+    connection = Depends(get_db_connection)
+):
+    try:
+        position = decode_change_cursor(since)
+    except ValueError:
+        return HTTPException(status_code=400, detail="Invalid cursor")
+
+    try:
+        if since and await profile_changes_expired(connection, position):
+            await connection.rollback()
+            return HTTPException(status_code=410, detail="Cursor is older than the retained changes")
+        changes = await fetch_profile_changes(connection, position, limit)
+    except Exception as e:
+        logger.error(f"Error retrieving profile changes: {e}")
+        return HTTPException(status_code=500, detail="Internal Server Error")
+
+    next_cursor = changes[-1]["cursor"] if changes else encode_change_cursor(*position)
+    return FastJSONResponse(changes, headers={"X-Next-Cursor": next_cursor})
+
+#The same changes pushed as server-sent events, each with its cursor as the
+#event id, so a reconnecting EventSource resumes from Last-Event-ID.
+#Both endpoints answer 410 when changes after the cursor were already pruned:
+#the consumer has missed some and needs to resync (e.g. from /profile/export).
+@app.get("/profile/changes/stream")
+async def stream_profile_changes(request: Request, since: str = Query(None)):
+    since = request.headers.get("last-event-id") or since
+    try:
+        position = decode_change_cursor(since)
+    except ValueError:
+        return HTTPException(status_code=400, detail="Invalid cursor")
+    if pool is None:
+        return HTTPException(status_code=503, detail="Database not ready")
+
+    if since:
+        try:
+            async with read_connection(pool) as connection:
+                expired = await profile_changes_expired(connection, position)
+        except Exception as e:
+            logger.error(f"Error checking the change cursor: {e}")
+            return HTTPException(status_code=500, detail="Internal Server Error")
+        if expired:
+            return HTTPException(status_code=410, detail="Cursor is older than the retained changes")
+
+    return StreamingResponse(
+        profile_change_events(position),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# Sends every change after position, then follows the worker's tail of recent
+# changes. Only a stream behind the tail reads the outbox itself, checking out
+# a connection for each page until it has caught up.
+async def profile_change_events(position):
+    waiter = asyncio.Event()
+    profile_change_waiters.add(waiter)
+    try:
+        while True:
+            waiter.clear()
+            changes = profile_change_tail.after(position)
+            caught_up = changes is not None
+            if changes is None:
+                async with pool.connection() as connection:
+                    changes = await fetch_profile_changes(connection, position, PROFILE_CHANGES_PAGE_MAX_SIZE)
+                caught_up = len(changes) < PROFILE_CHANGES_PAGE_MAX_SIZE
+            for change in changes:
+                yield f"id: {change['cursor']}\nevent: profile_change\ndata: {dumps_json(change)}\n\n"
+            if changes:
+                position = decode_change_cursor(changes[-1]["cursor"])
+            if not caught_up:
+                continue
+            try:
+                await asyncio.wait_for(waiter.wait(), PROFILE_CHANGES_STREAM_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+    finally:
+        profile_change_waiters.discard(waiter)
+
+#Stream every users profile with its images, as NDJSON or CSV.
+#The response's X-Export-Watermark is passed back as since= on the next export
+#to get only the profiles changed in between.
+@app.get("/profile/export")
+async def export_users(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    since: int = Query(None, ge=0)
+):
+    # Checked up front, since a failure inside the stream comes after the 200
+    if pool is None:
+        raise HTTPException(status_code=503, detail="Database not ready")
+
+    # The watermark is the oldest transaction still running: every write
+    # below it has committed, and every later one will be at or above it.
+    # Exporting [since, watermark) therefore never skips a slow transaction's
+    # rows, however late it commits.
+    export_pool = get_read_pool()
+    try:
+        async with read_connection(export_pool) as connection, connection.cursor() as cursor:
+            await cursor.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text")
+            watermark = int((await cursor.fetchone())[0])
+    except Exception as e:
+        logger.error(f"Error starting profile export: {e}")
+        return HTTPException(status_code=500, detail="Internal Server Error")
+
+    media_type = "application/x-ndjson" if format == "ndjson" else "text/csv"
+    return StreamingResponse(
+        stream_profiles_export(export_pool, format, since, watermark),
+        media_type=media_type,
+        headers={"X-Export-Watermark": str(watermark)},
+    )
+
+#Get a presigned POST that lets the client upload a profile image straight to S3.
+#The key is limited to the user's upload prefix, the size to IMAGE_UPLOAD_MAX_BYTES
+#and the Content-Type to the one given; the upload is then completed through
+#/profile/{email}/image/confirm.
+@app.post("/profile/{email}/image/upload-url")
+async def create_image_upload_url(
+    email: str,
+    content_type: str = Form(...),
+    filename: str = Form("image"),
+    connection = Depends(get_db_connection)
+):
+    if content_type not in IMAGE_UPLOAD_CONTENT_TYPES:
+        return HTTPException(status_code=400, detail="Unsupported image type")
+
+    try:
+        async with connection.cursor() as cursor:
+            await cursor.execute("SELECT user_id FROM users_profile WHERE email = %s", (email,), prepare=True)
+            user = await cursor.fetchone()
+        await connection.rollback()
+
+        if not user:
+            return HTTPException(status_code=404, detail="User not found")
+
+        object_key = f"{image_upload_prefix(user[0])}{uuid4()}_{os.path.basename(filename)}"
+        presign = partial(
+            get_s3().generate_presigned_post,
+            AWS_BUCKET,
+            object_key,
+            Fields={"acl": "public-read", "Content-Type": content_type},
+            Conditions=[
+                {"acl": "public-read"},
+                {"Content-Type": content_type},
+                ["content-length-range", 1, IMAGE_UPLOAD_MAX_BYTES],
+            ],
+            ExpiresIn=IMAGE_UPLOAD_URL_EXPIRES,
+        )
+        presigned_post = await anyio.to_thread.run_sync(presign, limiter=s3_limiter)
+
+        return {"key": object_key, "url": presigned_post["url"], "fields": presigned_post["fields"]}
+
+    except Exception as e:
+        logger.error(f"Error creating image upload url: {e}")
+        return HTTPException(status_code=500, detail="Internal Server Error")
+
+#Record an image the client uploaded through a presigned POST as the user's image.
+#Its variants are generated in the background once the response is sent.
+@app.post("/profile/{email}/image/confirm")
+async def confirm_image_upload(
+    email: str,
+    background_tasks: BackgroundTasks,
+    key: str = Form(...),
+):
+    if pool is None:
+        raise HTTPException(status_code=503, detail="Database not ready")
+
+    try:
+        # Ownership is settled before any S3 call, so a caller can neither probe
+        # nor delete objects outside their own upload prefix. The lookup's
+        # connection goes back to the pool before S3 is called.
+        async with read_connection(pool) as connection, connection.cursor() as cursor:
+            await cursor.execute("SELECT user_id FROM users_profile WHERE email = %s", (email,), prepare=True)
+            user = await cursor.fetchone()
+
+        if not user:
+            return HTTPException(status_code=404, detail="User not found")
+
+        user_id = str(user[0])
+        if not key.startswith(image_upload_prefix(user_id)):
+            return HTTPException(status_code=403, detail="Image belongs to another user")
+
+        head = partial(get_s3().head_object, Bucket=AWS_BUCKET, Key=key)
+        try:
+            uploaded_object = await anyio.to_thread.run_sync(head, limiter=s3_limiter)
+        except ClientError:
+            return HTTPException(status_code=404, detail="Uploaded image not found")
+
+        if uploaded_object["ContentLength"] > IMAGE_UPLOAD_MAX_BYTES or uploaded_object["ContentType"] not in IMAGE_UPLOAD_CONTENT_TYPES:
+            await delete_images_from_s3([key])
+            return HTTPException(status_code=400, detail="Invalid image")
+
+        # The pool rolls back a connection returned mid-transaction
+        async with pool.connection() as connection, connection.cursor() as cursor:
+            image_url = s3_object_url(key)
+            image_name = key.rsplit("/", 1)[1].split("_", 1)[-1]
+            await upsert_image_data(cursor, image_name, image_url, {"original": image_url}, user_id)
+            await touch_user_profile(cursor, user_id)
+            await record_profile_change(cursor, user_id, email, "image_updated")
+            await connection.commit()
+            profile_cache.invalidate(email)
+            pin_to_primary(email, user_id)
+
+        background_tasks.add_task(add_image_variants, email, user_id, key)
+
+        return {"message": "User Profile image updated successfully!", "image": image_url}
+
+    except Exception as e:
+        logger.error(f"Error confirming image upload: {e}")
+        return HTTPException(status_code=500, detail="Internal Server Error")
+
 #Get user's profile given an email
-@app.get("/profile/{email}")
-async def get_user(email: str):
-    global connection
+@app.get("/profile/{email}", responses={200: {"model": UserProfile}})
+async def get_user(email: str, request: Request):
+    if_none_match = request.headers.get("if-none-match")
+
+    cached_user = profile_cache.get(email)
+    if cached_user is not None:
+        etag = profile_etag(cached_user["updated_at"])
+        if etag_matches(if_none_match, etag):
+            return not_modified_response(etag)
+        return FastJSONResponse(cached_user, headers=profile_cache_headers(etag))
+
+    if pool is None:
+        raise HTTPException(status_code=503, detail="Database not ready")
+
+    cache_version = profile_cache.version
     try:
-        with connection.cursor() as cursor:
-            select_query = "SELECT * FROM users_profile WHERE email = %s"
-            cursor.execute(select_query, (email,))
-            user = cursor.fetchone()
+        # Checked out only on a cache miss, so hits never wait on the pool
+        async with read_connection(get_read_pool((email,))) as connection, connection.cursor(row_factory=dict_row) as cursor:
+            # A client revalidating its copy only costs a primary key lookup
+            if if_none_match:
+                with observe_stage("db", "select_profile_version"):
+                    await cursor.execute("SELECT updated_at FROM users_profile WHERE email = %s", (email,), prepare=True)
+                    version = await cursor.fetchone()
+                if version and etag_matches(if_none_match, profile_etag(version["updated_at"])):
+                    return not_modified_response(profile_etag(version["updated_at"]))
+
+            # Profile and image URLs in one round trip, as a server-side prepared statement
+            select_query = PROFILE_SELECT.format(where="p.email = %s")
+            with observe_stage("db", "select_profile"):
+                await cursor.execute(select_query, (email,), prepare=True)
+                user_info = await cursor.fetchone()
 
-            if not user:
+            if not user_info:
                 return HTTPException(status_code=404, detail="User not found")
-            
-            image = get_images_for_users_profile(str(user[0]), cursor)
-
-            user_info = {
-                "user_id": user[0],
-                "username": user[1],
-                "email": user[2],
-                "locality": user[3],
-                "first_name": user[4],
-                "last_name": user[5],
-                "description": user[6],
-                "interests": user[7],
-                "image": image
-            }
-
-            return user_info
+
+            profile_cache.set(email, user_info, cache_version)
+
+            # Returned as a response so the row is encoded once, without a jsonable_encoder pass
+            return FastJSONResponse(user_info, headers=profile_cache_headers(profile_etag(user_info["updated_at"])))
 
     except Exception as e:
         logger.error(f"Error retrieving user: {e}")
         return HTTPException(status_code=500, detail="Internal Server Error")
 
-#Get user's with the given interest    
-@app.get("/profile/users/{interest}")
-async def get_users_by_interest(interest: str):
-    global connection
+#Bulk create users profiles from a CSV (with a header row) or NDJSON file
+@app.post("/profile/import")
+async def import_users(
+    file: UploadFile = File(...),
+    format: str = Form(None),
+    connection = Depends(get_db_connection)
+):
+    import_format = format or guess_import_format(file.filename)
+    if import_format not in IMPORT_FORMATS:
+        return HTTPException(status_code=400, detail=f"Unsupported import format, expected one of {', '.join(IMPORT_FORMATS)}")
+
     try:
-        with connection.cursor() as cursor:
-            select_query = "SELECT email FROM users_profile WHERE interests @> %s::jsonb"
-            cursor.execute(select_query, (json.dumps([{"interest": interest}]),))
-            emails_with_interest = cursor.fetchall()
+        lines = io.TextIOWrapper(file.file, encoding="utf-8", newline="")
+        result = await import_profiles(connection, lines, import_format)
+        await connection.commit()
 
-            email_list = [user[0] for user in emails_with_interest]
+        return result
 
-            return email_list
+    except Exception as e:
+        await connection.rollback()
+        logger.error(f"Error importing profiles: {e}")
+        return HTTPException(status_code=500, detail="Internal Server Error")
+
+#Get several users' profiles given their emails and/or user_ids
+@app.post("/profile/batch", responses={200: {"model": ProfileBatchResponse}})
+async def get_users_batch(batch: ProfileBatchRequest):
+    emails = list(dict.fromkeys(batch.emails))
+    user_ids = list(dict.fromkeys(batch.user_ids))
+
+    if len(emails) + len(user_ids) > PROFILE_BATCH_MAX_SIZE:
+        return HTTPException(status_code=400, detail=f"Batch size exceeds the maximum of {PROFILE_BATCH_MAX_SIZE}")
+
+    profiles = {}
+    emails_to_fetch = []
+    for email in emails:
+        cached_user = profile_cache.get(email)
+        if cached_user is not None:
+            profiles[cached_user["user_id"]] = cached_user
+        else:
+            emails_to_fetch.append(email)
+
+    if (emails_to_fetch or user_ids) and pool is None:
+        raise HTTPException(status_code=503, detail="Database not ready")
+
+    cache_version = profile_cache.version
+    try:
+        if emails_to_fetch or user_ids:
+            async with read_connection(get_read_pool([*emails_to_fetch, *user_ids])) as connection, connection.cursor(row_factory=dict_row) as cursor:
+                select_query = PROFILE_SELECT.format(where="p.email = ANY(%s::varchar[]) OR p.user_id = ANY(%s::uuid[])")
+                with observe_stage("db", "select_profile_batch"):
+                    await cursor.execute(select_query, (emails_to_fetch, user_ids), prepare=True)
+                    rows = await cursor.fetchall()
+                for user_info in rows:
+                    profiles[user_info["user_id"]] = user_info
+                    profile_cache.set(user_info["email"], user_info, cache_version)
+
+        found_emails = {user_info["email"] for user_info in profiles.values()}
+        found_user_ids = {str(user_id) for user_id in profiles}
+
+        return FastJSONResponse({
+            "profiles": list(profiles.values()),
+            "missing": {
+                "emails": [email for email in emails if email not in found_emails],
+                "user_ids": [user_id for user_id in user_ids if str(user_id) not in found_user_ids],
+            },
+        })
 
     except Exception as e:
-        logger.error(f"Error retrieving user emails by interest: {e}")
+        logger.error(f"Error retrieving users batch: {e}")
         return HTTPException(status_code=500, detail="Internal Server Error")
-   
-   
-#Just for Debugging... 
-# @app.get("/profile/all/")
-# async def get_all_users():
-#     global connection
-#     try:
-#         with connection.cursor() as cursor:
-#             select_all_query = "SELECT * FROM users_profile"
-#             cursor.execute(select_all_query)
-#             all_users = cursor.fetchall()
-
-#             user_list = [
-#                 {
-#                     "user_id": user[0],
-#                     "username": user[1],
-#                     "email": user[2],
-#                     "locality": user[3],
-#                     "first_name": user[4],
-#                     "last_name": user[5],
-#                     "description": user[6],
-#                     "interests": user[7],
-#                 }
-#                 for user in all_users
-#             ]
-
-#             return user_list
 
-#     except Exception as e:
-#         logger.error(f"Error retrieving all users: {e}")
-#         return HTTPException(status_code=500, detail="Internal Server Error")    
+#Get the most popular interests, optionally within a locality
+@app.get("/profile/interests/top")
+async def get_top_interests(
+    locality: str = Query(None),
+    limit: int = Query(10, ge=1, le=100),
+    connection = Depends(get_read_db_connection)
+):
+    try:
+        async with connection.cursor() as cursor:
+            # Reads the maintained counters, so cost depends on limit, not on the number of users
+            if locality:
+                select_query = """
+                    SELECT i.name, c.user_count
+                    FROM interest_locality_counts c
+                    JOIN interests i ON i.interest_id = c.interest_id
+                    WHERE c.locality = %s AND c.user_count > 0
+                    ORDER BY c.user_count DESC
+                    LIMIT %s
+                """
+                await cursor.execute(select_query, (locality, limit), prepare=True)
+            else:
+                select_query = """
+                    SELECT name, user_count
+                    FROM interests
+                    WHERE user_count > 0
+                    ORDER BY user_count DESC
+                    LIMIT %s
+                """
+                await cursor.execute(select_query, (limit,), prepare=True)
+            top_interests = await cursor.fetchall()
+
+            return [{"interest": row[0], "count": row[1]} for row in top_interests]
 
+    except Exception as e:
+        logger.error(f"Error retrieving top interests: {e}")
+        return HTTPException(status_code=500, detail="Internal Server Error")
+
+#Get the profile cache counters
+@app.get("/profile/cache/stats")
+async def get_profile_cache_stats():
+    return profile_cache.stats()
+
+#Get user's with the given interest(s), a page at a time.
+#Several interests can be passed comma-separated and matched with match=any|all;
+#when there are more results the next page's "after" value is sent in X-Next-Cursor.
+@app.get("/profile/users/{interest}", responses={200: {"model": list[str]}})
+async def get_users_by_interest(
+    interest: str,
+    match: str = Query("any", pattern="^(any|all)$"),
+    limit: int = Query(INTEREST_PAGE_SIZE, ge=1, le=INTEREST_PAGE_MAX_SIZE),
+    after: str = Query(None),
+    connection = Depends(get_read_db_connection)
+):
+    interests_list = [item.strip() for item in interest.split(',') if item.strip()]
+    if not interests_list:
+        return []
+    if len(interests_list) > INTEREST_MAX_TERMS:
+        return HTTPException(status_code=400, detail=f"At most {INTEREST_MAX_TERMS} interests can be searched at once")
+
+    # Every condition is a plain containment test, so each one can use the GIN index
+    if match == "all":
+        conditions = "interests @> %s::jsonb"
+        params = [dumps_json([{"interest": item} for item in interests_list])]
+    else:
+        conditions = " OR ".join(["interests @> %s::jsonb"] * len(interests_list))
+        params = [dumps_json([{"interest": item}]) for item in interests_list]
 
+    select_query = f"SELECT email FROM users_profile WHERE ({conditions})"
+    if after:
+        select_query += " AND email > %s"
+        params.append(after)
+    # One extra row tells us whether there is a next page
+    select_query += " ORDER BY email LIMIT %s"
+    params.append(limit + 1)
 
+    try:
+        async with connection.cursor() as cursor:
+            with observe_stage("db", "select_users_by_interest"):
+                await cursor.execute(select_query, params)
+                emails_with_interest = await cursor.fetchall()
+
+            email_list = [user[0] for user in emails_with_interest[:limit]]
+            headers = {"X-Next-Cursor": email_list[-1]} if len(emails_with_interest) > limit else None
+
+            return FastJSONResponse(email_list, headers=headers)
+
+    except Exception as e:
+        logger.error(f"Error retrieving user emails by interest: {e}")
+        return HTTPException(status_code=500, detail="Internal Server Error")
+   
+   
 #Just for Debugging...
 # @app.delete("/deleteGender/")
 # async def remove_gender():
@@ -269,66 +1533,798 @@ async def get_users_by_interest(interest: str):
 #         logger.error(f"Error retrieving all users: {e}")
 #         return HTTPException(status_code=500, detail="Internal Server Error") 
 
-def create_tables():
-    try:
-        global connection, cursor
+# Schema migrations, applied in order and recorded in schema_migrations so each
+# runs once per database. Append new ones; never change one that has shipped.
+# Databases created before migrations were tracked already hold some of this
+# schema, hence the IF NOT EXISTS throughout.
+async def migrate_normalized_interests(cursor):
+    # Normalized interests: a dictionary of names with a maintained user
+    # count, the user <-> interest links and per-locality counts for facets
+    await cursor.execute("""
+        CREATE TABLE IF NOT EXISTS interests (
+            interest_id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            user_count INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS interests_user_count_idx ON interests (user_count DESC);
+
+        CREATE TABLE IF NOT EXISTS user_interests (
+            user_profile_id UUID REFERENCES users_profile(user_id) ON DELETE CASCADE,
+            interest_id INTEGER REFERENCES interests(interest_id),
+            PRIMARY KEY (user_profile_id, interest_id)
+        );
+
+        CREATE TABLE IF NOT EXISTS interest_locality_counts (
+            locality VARCHAR NOT NULL,
+            interest_id INTEGER REFERENCES interests(interest_id),
+            user_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (locality, interest_id)
+        );
+        CREATE INDEX IF NOT EXISTS interest_locality_counts_top_idx ON interest_locality_counts (locality, user_count DESC);
+    """)
+    await backfill_user_interests(cursor)
+
+# Proximity search: the gazetteer as a table, and each profile's locality
+# geocoded into a GiST-indexed point(longitude, latitude). The trigger geocodes
+# on every write of locality, COPY imports included; unknown localities get no
+# location and simply don't show up in proximity searches.
+async def migrate_locality_coordinates(cursor):
+    await cursor.execute("""
+        CREATE TABLE IF NOT EXISTS localities (
+            name TEXT PRIMARY KEY,
+            latitude DOUBLE PRECISION NOT NULL,
+            longitude DOUBLE PRECISION NOT NULL
+        );
+        ALTER TABLE users_profile ADD COLUMN IF NOT EXISTS location point;
+    """)
+    await load_gazetteer(cursor)
+    await cursor.execute("""
+        CREATE OR REPLACE FUNCTION users_profile_geocode() RETURNS trigger AS $$
+        BEGIN
+            NEW.location := (
+                SELECT point(l.longitude, l.latitude) FROM localities l
+                WHERE l.name = lower(btrim(NEW.locality))
+            );
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS users_profile_geocode ON users_profile;
+        CREATE TRIGGER users_profile_geocode
+            BEFORE INSERT OR UPDATE OF locality ON users_profile
+            FOR EACH ROW EXECUTE FUNCTION users_profile_geocode();
+
+        UPDATE users_profile p
+        SET location = point(l.longitude, l.latitude)
+        FROM localities l
+        WHERE l.name = lower(btrim(p.locality));
 
-        # Create the 'users' table
-        create_users_table = """
-            CREATE TABLE IF NOT EXISTS users_profile (
-                user_id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
+        CREATE INDEX IF NOT EXISTS users_profile_location_idx ON users_profile USING GIST (location);
+    """)
+
+MIGRATIONS = [
+    (1, "create_profiles_and_images", """
+        CREATE TABLE IF NOT EXISTS users_profile (
+            user_id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
+            username VARCHAR NOT NULL,
+            email VARCHAR NOT NULL UNIQUE,
+            locality VARCHAR,
+            first_name VARCHAR,
+            last_name VARCHAR,
+            description TEXT,
+            interests JSONB
+        );
+
+        CREATE TABLE IF NOT EXISTS images (
+            id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
+            image_name TEXT NOT NULL,
+            image_url TEXT NOT NULL,
+            user_profile_id UUID REFERENCES users_profile(user_id) ON DELETE CASCADE
+        );
+
+        -- Interest searches are jsonb containment (@>) queries
+        CREATE INDEX IF NOT EXISTS users_profile_interests_idx ON users_profile USING GIN (interests jsonb_path_ops);
+    """),
+    # Last modification time, used for ETags
+    (2, "profile_updated_at", """
+        ALTER TABLE users_profile ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now();
+        CREATE INDEX IF NOT EXISTS users_profile_updated_at_idx ON users_profile (updated_at, user_id);
+    """),
+    # URLs of the resized/re-encoded copies of the image, by variant name
+    (3, "image_variants", """
+        ALTER TABLE images ADD COLUMN IF NOT EXISTS variants JSONB;
+    """),
+    # One image per profile. The unique index backs both the image upsert
+    # and the profile reads that join images on the owning profile.
+    # Duplicates could only come from racing inserts, which the old update
+    # path had already overwritten with the same values.
+    (4, "one_image_per_profile", """
+        DELETE FROM images a USING images b
+        WHERE a.user_profile_id = b.user_profile_id AND a.ctid < b.ctid
+          AND NOT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'images_user_profile_id_key');
+        CREATE UNIQUE INDEX IF NOT EXISTS images_user_profile_id_key ON images (user_profile_id);
+        DROP INDEX IF EXISTS images_user_profile_id_idx;
+    """),
+    (5, "normalized_interests", migrate_normalized_interests),
+    # Profile search: a generated (so always current) weighted tsvector for
+    # full-text and prefix matching, and trigrams for fuzzy username matches
+    (6, "profile_search", """
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        ALTER TABLE users_profile ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('simple', coalesce(username, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(first_name, '') || ' ' || coalesce(last_name, '')), 'B') ||
+            setweight(to_tsvector('simple', coalesce(description, '')), 'C')
+        ) STORED;
+        CREATE INDEX IF NOT EXISTS users_profile_search_idx ON users_profile USING GIN (search_vector);
+        CREATE INDEX IF NOT EXISTS users_profile_username_trgm_idx ON users_profile USING GIN (lower(username) gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS users_profile_locality_idx ON users_profile (locality);
+    """),
+    # Transactional outbox behind the change feed. txid orders changes by
+    # writing transaction; changes are kept for PROFILE_CHANGES_RETENTION.
+    (7, "profile_changes_outbox", """
+        CREATE TABLE IF NOT EXISTS profile_changes (
+            change_id BIGSERIAL PRIMARY KEY,
+            txid xid8 NOT NULL DEFAULT pg_current_xact_id(),
+            user_id UUID NOT NULL,
+            email VARCHAR NOT NULL,
+            operation TEXT NOT NULL,
+            changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE INDEX IF NOT EXISTS profile_changes_position_idx ON profile_changes (txid, change_id);
+        CREATE INDEX IF NOT EXISTS profile_changes_changed_at_idx ON profile_changes (changed_at);
+    """),
+    # Writing transaction of each profile's last change, the export watermark.
+    # updated_at can't be one: now() is the transaction's start, not its commit.
+    # Added with a constant default so existing rows aren't rewritten.
+    (8, "profile_change_txid", """
+        ALTER TABLE users_profile ADD COLUMN IF NOT EXISTS change_txid xid8 NOT NULL DEFAULT '0';
+        ALTER TABLE users_profile ALTER COLUMN change_txid SET DEFAULT pg_current_xact_id();
+        CREATE INDEX IF NOT EXISTS users_profile_change_txid_idx ON users_profile (change_txid);
+    """),
+    (9, "locality_coordinates", migrate_locality_coordinates),
+    # Position of the newest pruned change. A feed consumer whose cursor is
+    # behind it has missed changes, and is told so with a 410.
+    (10, "profile_changes_horizon", """
+        CREATE TABLE IF NOT EXISTS profile_changes_horizon (
+            id BOOLEAN PRIMARY KEY DEFAULT true CHECK (id),
+            txid xid8 NOT NULL,
+            change_id BIGINT NOT NULL
+        );
+    """),
+]
+
+# Applies the pending migrations in one transaction, under an advisory lock so
+# concurrent starts wait for the first one instead of racing it. When the
+# schema is current this is a lock and a single SELECT.
+async def migrate(connection):
+    async with connection.cursor() as cursor:
+        # Index builds and table rewrites outlast the pool's statement timeout,
+        # as does waiting on the lock while another pod migrates
+        await cursor.execute("SELECT set_config('statement_timeout', '0', true)")
+        await cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATIONS_LOCK_ID,))
+        await cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        """)
+        await cursor.execute("SELECT version FROM schema_migrations")
+        applied = {row[0] for row in await cursor.fetchall()}
+
+        for version, name, migration in MIGRATIONS:
+            if version in applied:
+                continue
+            if callable(migration):
+                await migration(cursor)
+            else:
+                await cursor.execute(migration)
+            await cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+            logger.info(f"Applied migration {version} {name}")
+
+    await connection.commit()
+
+# Returns the new user's row, or None when the email is already taken
+async def insert_user_profile_data(cursor, username, email, locality, first_name, last_name, description):
+    insert_query = """
+        INSERT INTO users_profile (username, email, locality, first_name, last_name, description, interests)
+        VALUES (%s, %s, %s, %s, %s, %s, %s::jsonb)
+        ON CONFLICT (email) DO NOTHING
+        RETURNING user_id
+    """
+    await cursor.execute(insert_query, (username, email, locality, first_name, last_name, description, "[]"), prepare=True)
+    return await cursor.fetchone()
+
+# Fills the normalized interest tables from users_profile.interests the first
+# time they are created; later writes keep them up to date incrementally.
+async def backfill_user_interests(cursor):
+    await cursor.execute("SELECT EXISTS (SELECT 1 FROM user_interests)")
+    if (await cursor.fetchone())[0]:
+        return
+
+    user_interest_names = """
+        SELECT DISTINCT p.user_id, item->>'interest' AS name
+        FROM users_profile p, jsonb_array_elements(p.interests) AS item
+        WHERE jsonb_typeof(p.interests) = 'array' AND COALESCE(item->>'interest', '') <> ''
+    """
+    await cursor.execute(f"""
+        INSERT INTO interests (name)
+        SELECT DISTINCT name FROM ({user_interest_names}) AS u
+        ON CONFLICT (name) DO NOTHING
+    """)
+    await cursor.execute(f"""
+        INSERT INTO user_interests (user_profile_id, interest_id)
+        SELECT u.user_id, i.interest_id
+        FROM ({user_interest_names}) AS u
+        JOIN interests i ON i.name = u.name
+        ON CONFLICT DO NOTHING
+    """)
+
+    await cursor.execute("""
+        UPDATE interests i
+        SET user_count = (SELECT count(*) FROM user_interests ui WHERE ui.interest_id = i.interest_id)
+    """)
+    await cursor.execute("""
+        INSERT INTO interest_locality_counts (locality, interest_id, user_count)
+        SELECT p.locality, ui.interest_id, count(*)
+        FROM user_interests ui
+        JOIN users_profile p ON p.user_id = ui.user_profile_id
+        WHERE p.locality IS NOT NULL
+        GROUP BY p.locality, ui.interest_id
+        ON CONFLICT (locality, interest_id) DO UPDATE SET user_count = EXCLUDED.user_count
+    """)
+
+# Brings user_interests and the interest counters in line with a user's new
+# interests. Only the difference from the stored set is written, so counters
+# of interests the user keeps are left alone.
+async def sync_user_interests(connection, user_id, old_locality, new_locality, interest_names):
+    new_names = list(dict.fromkeys(name for name in interest_names if name))
+
+    async with connection.cursor() as cursor:
+        await cursor.execute("SELECT interest_id FROM user_interests WHERE user_profile_id = %s", (user_id,), prepare=True)
+        old_ids = {row[0] for row in await cursor.fetchall()}
+
+        new_ids = set()
+        if new_names:
+            await cursor.execute("INSERT INTO interests (name) SELECT unnest(%s::text[]) ON CONFLICT (name) DO NOTHING", (new_names,))
+            await cursor.execute("SELECT interest_id FROM interests WHERE name = ANY(%s::text[])", (new_names,))
+            new_ids = {row[0] for row in await cursor.fetchall()}
+
+        removed_ids = sorted(old_ids - new_ids)
+        added_ids = sorted(new_ids - old_ids)
+
+        if removed_ids:
+            await cursor.execute(
+                "DELETE FROM user_interests WHERE user_profile_id = %s AND interest_id = ANY(%s::int[])",
+                (user_id, removed_ids),
+            )
+        if added_ids:
+            await cursor.execute(
+                "INSERT INTO user_interests (user_profile_id, interest_id) SELECT %s, unnest(%s::int[])",
+                (user_id, added_ids),
+            )
+
+        # Rows are touched in interest_id order to avoid deadlocks between concurrent edits
+        deltas = sorted([(interest_id, -1) for interest_id in removed_ids] + [(interest_id, 1) for interest_id in added_ids])
+        if deltas:
+            await cursor.execute(
+                """
+                UPDATE interests i SET user_count = i.user_count + d.delta
+                FROM unnest(%s::int[], %s::int[]) AS d(interest_id, delta)
+                WHERE i.interest_id = d.interest_id
+                """,
+                ([interest_id for interest_id, _ in deltas], [delta for _, delta in deltas]),
+            )
+
+        # A locality change moves all of the user's interests between localities
+        if old_locality == new_locality:
+            locality_deltas = [(old_locality, interest_id, -1) for interest_id in removed_ids] + [(new_locality, interest_id, 1) for interest_id in added_ids]
+        else:
+            locality_deltas = [(old_locality, interest_id, -1) for interest_id in old_ids] + [(new_locality, interest_id, 1) for interest_id in new_ids]
+        locality_deltas = sorted(item for item in locality_deltas if item[0] is not None)
+        if locality_deltas:
+            await cursor.execute(
+                """
+                INSERT INTO interest_locality_counts (locality, interest_id, user_count)
+                SELECT * FROM unnest(%s::varchar[], %s::int[], %s::int[])
+                ON CONFLICT (locality, interest_id) DO UPDATE
+                SET user_count = interest_locality_counts.user_count + EXCLUDED.user_count
+                """,
+                tuple(list(column) for column in zip(*locality_deltas)),
+            )
+
+def guess_import_format(filename):
+    if filename and filename.lower().endswith((".ndjson", ".jsonl")):
+        return "ndjson"
+    return "csv"
+
+# Yields (line number, record) pairs without reading the whole input.
+# Records that can't be parsed are yielded as None.
+def parse_import_records(lines, import_format):
+    if import_format == "csv":
+        reader = csv.DictReader(lines)
+        for record in reader:
+            yield reader.line_num, record
+    else:
+        for line_no, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield line_no, record if isinstance(record, dict) else None
+
+# Streams the records into a temporary staging table with COPY, then creates
+# every new profile with a single INSERT ... ON CONFLICT. Rows whose email
+# already exists, or repeats an earlier row of the same file, are reported
+# back as conflicts instead of being written.
+async def import_profiles(connection, lines, import_format):
+    invalid = []
+
+    async with connection.cursor() as cursor:
+        # Local to the import's transaction; the pooled connection gets its own back after
+        await cursor.execute("SELECT set_config('statement_timeout', %s, true)", (str(IMPORT_STATEMENT_TIMEOUT_MS),))
+        await cursor.execute("""
+            CREATE TEMP TABLE users_profile_import (
+                line_no INTEGER NOT NULL,
                 username VARCHAR NOT NULL,
-                email VARCHAR NOT NULL UNIQUE,
+                email VARCHAR NOT NULL,
                 locality VARCHAR,
                 first_name VARCHAR,
                 last_name VARCHAR,
-                description TEXT,
-                interests JSONB
-            );
-        """
+                description TEXT
+            ) ON COMMIT DROP
+        """)
 
-        cursor = connection.cursor()
-        cursor.execute(create_users_table)
-        
-        create_images_table = """
-            CREATE TABLE IF NOT EXISTS images (
-                id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
-                image_name TEXT NOT NULL,
-                image_url TEXT NOT NULL,
-                user_profile_id UUID REFERENCES users_profile(user_id) ON DELETE CASCADE
-            );
+        staged = 0
+        copy_query = f"COPY users_profile_import (line_no, {', '.join(IMPORT_COLUMNS)}) FROM STDIN"
+        async with cursor.copy(copy_query) as copy:
+            for line_no, record in parse_import_records(lines, import_format):
+                if record is None:
+                    invalid.append({"line": line_no, "error": "Malformed record"})
+                    continue
+                values = [(record.get(column) or None) for column in IMPORT_COLUMNS]
+                if not values[0] or not values[1]:
+                    invalid.append({"line": line_no, "error": "username and email are required"})
+                    continue
+                await copy.write_row([line_no, *values])
+                staged += 1
+
+        # Temp tables are never auto-analyzed; without statistics the planner
+        # assumes a handful of rows and picks plans that don't scale with them
+        await cursor.execute("ANALYZE users_profile_import")
+
+        upsert_query = """
+            WITH candidates AS (
+                SELECT DISTINCT ON (email) line_no, username, email, locality, first_name, last_name, description
+                FROM users_profile_import
+                ORDER BY email, line_no
+            ),
+            inserted AS (
+                INSERT INTO users_profile (username, email, locality, first_name, last_name, description, interests)
+                SELECT username, email, locality, first_name, last_name, description, '[]'::jsonb
+                FROM candidates
+                ON CONFLICT (email) DO NOTHING
+                RETURNING user_id, email
+            ),
+            changes AS (
+                INSERT INTO profile_changes (user_id, email, operation)
+                SELECT user_id, email, 'created' FROM inserted
+            )
+            -- A row was written only if it was its email's candidate and that
+            -- email was inserted; one anti-join instead of NOT IN subplans,
+            -- which degrade to a rescan per row once they outgrow work_mem
+            SELECT s.line_no, s.email
+            FROM users_profile_import s
+            WHERE NOT EXISTS (
+                SELECT 1 FROM candidates c JOIN inserted i ON i.email = c.email
+                WHERE c.line_no = s.line_no
+            )
+            ORDER BY s.line_no
         """
-        cursor.execute(create_images_table)
-        
-        connection.commit()
-        logger.info("Tables created successfully in PostgreSQL database")
+        await cursor.execute(upsert_query)
+        conflicts = [{"line": row[0], "email": row[1]} for row in await cursor.fetchall()]
+
+        # One wake-up for the change streams; the new profiles aren't cached
+        # anywhere yet, so there's nothing to invalidate by email
+        if staged > len(conflicts):
+            await cursor.execute("SELECT pg_notify(%s, '')", (PROFILE_CHANGES_CHANNEL,))
+
+    return {
+        "inserted": staged - len(conflicts),
+        "conflicts": conflicts,
+        "invalid": invalid,
+    }
+
+def export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+# Reads the export through a named (server-side) cursor, so only one chunk of
+# rows is held in memory at a time, and yields each chunk already encoded.
+async def stream_profiles_export(export_pool, export_format, since, watermark):
+    select_query = f"""
+        SELECT p.user_id, p.username, p.email, p.locality, p.first_name,
+               p.last_name, p.description, p.interests, p.updated_at,
+               ARRAY(SELECT i.image_url FROM images i WHERE i.user_profile_id = p.user_id) AS image
+        FROM users_profile p
+        WHERE p.change_txid < %s::text::xid8
+        {"AND p.change_txid >= %s::text::xid8" if since is not None else ""}
+    """
+    params = (str(watermark), str(since)) if since is not None else (str(watermark),)
+
+    try:
+        # The named cursor lives in this transaction, which is ended (rather than
+        # left for the pool to roll back) once the export is read
+        async with export_pool.connection() as connection, connection.transaction():
+            async with connection.cursor(name="profile_export", row_factory=dict_row) as cursor:
+                await cursor.execute(select_query, params)
+
+                if export_format == "csv":
+                    buffer = io.StringIO()
+                    writer = csv.writer(buffer)
+                    writer.writerow(EXPORT_COLUMNS)
+                    yield buffer.getvalue()
+
+                while rows := await cursor.fetchmany(EXPORT_CHUNK_SIZE):
+                    if export_format == "csv":
+                        buffer = io.StringIO()
+                        writer = csv.writer(buffer)
+                        for row in rows:
+                            row["interests"] = dumps_json(row["interests"])
+                            row["image"] = dumps_json(row["image"])
+                            writer.writerow([export_value(row[column]) if row[column] is not None else "" for column in EXPORT_COLUMNS])
+                        yield buffer.getvalue()
+                    else:
+                        yield "".join(dumps_json(row) + "\n" for row in rows)
+
+    except Exception as e:
+        # The status line has already been sent, so all we can do is stop the stream
+        logger.error(f"Error exporting profiles: {e}")
+        raise
+
+# Re-encodes the uploaded image into every size in IMAGE_VARIANT_SIZES, as
+# JPEG and WebP. The full-size JPEG isn't produced since the uploaded file is
+# kept as the original. Returns (variant name, extension, content type, bytes).
+# Images over IMAGE_MAX_PIXELS raise Image.DecompressionBombError.
+def render_image_variants(fileobj):
+    fileobj.seek(0)
+    rendered = []
+    with Image.open(fileobj) as source:
+        # Pillow only raises past twice its limit, and only warns below that
+        if source.width * source.height > IMAGE_MAX_PIXELS:
+            raise Image.DecompressionBombError(f"Image has {source.width * source.height} pixels")
+        source.load()
+        ImageOps.exif_transpose(source, in_place=True)
+        variant = source if source.mode == "RGB" else source.convert("RGB")
 
-    except (Exception, psycopg2.DatabaseError) as error:
-        logger.error(f"Error creating table: {error}")
+        # Largest first, each one shrunk in place from the one before, so the
+        # full-size image is only resampled once and never copied
+        for name, size in sorted(IMAGE_VARIANT_SIZES.items(), key=lambda item: -(item[1] or float("inf"))):
+            if size:
+                variant.thumbnail((size, size))
 
+            encodings = [("webp", "image/webp", "WEBP")]
+            if size:
+                encodings.insert(0, ("jpg", "image/jpeg", "JPEG"))
 
-def insert_user_profile_data(cursor, username, email, locality, first_name, last_name, description):
-    insert_query = "INSERT INTO users_profile (username, email, locality, first_name, last_name, description, interests) VALUES (%s, %s, %s, %s, %s, %s, %s::jsonb)"
-    cursor.execute(insert_query, (username, email, locality, first_name, last_name, description, []))
+            for extension, content_type, pil_format in encodings:
+                buffer = io.BytesIO()
+                variant.save(buffer, pil_format, quality=IMAGE_QUALITY)
+                variant_name = name if extension == "jpg" else f"{name}_{extension}"
+                rendered.append((variant_name, extension, content_type, buffer.getvalue()))
+    fileobj.seek(0)
+    return rendered
 
-def upload_image_to_s3(image):
+def image_upload_prefix(user_id):
+    return f"uploads/{user_id}/"
+
+def s3_object_url(object_key):
+    if S3_ENDPOINT_URL:
+        return f"{S3_ENDPOINT_URL.rstrip('/')}/{AWS_BUCKET}/{object_key}"
+    return f"https://{AWS_BUCKET}.s3.amazonaws.com/{object_key}"
+
+# boto3 is blocking, so transfers run in worker threads bounded by the limiter.
+# upload_fileobj streams the spooled upload to S3 in multipart chunks.
+async def upload_fileobj_to_s3(fileobj, object_key, content_type):
+    upload = partial(
+        get_s3().upload_fileobj,
+        fileobj,
+        AWS_BUCKET,
+        object_key,
+        ExtraArgs={"ACL": "public-read", "ContentType": content_type},
+        Config=s3_transfer_config,
+    )
+    with observe_stage("s3", "upload"):
+        await anyio.to_thread.run_sync(upload, limiter=s3_limiter)
+
+# Renders the variants of an image in worker threads bounded by their own
+# limiter (Pillow releases the GIL while resizing and encoding).
+# Returns the uploads to make, as (file, object key, content type), and
+# the variant URLs by variant name.
+async def render_image_variant_uploads(fileobj, stem):
+    with observe_stage("image", "render_variants"):
+        variants = await anyio.to_thread.run_sync(partial(render_image_variants, fileobj), limiter=image_processing_limiter)
+
+    uploads = []
+    variant_urls = {}
+    for variant_name, extension, content_type, data in variants:
+        object_key = f"{stem}_{variant_name}.{extension}"
+        uploads.append((io.BytesIO(data), object_key, content_type))
+        variant_urls[variant_name] = s3_object_url(object_key)
+    return uploads, variant_urls
+
+# Runs the uploads concurrently; if any of them fails, the rest are removed
+async def upload_files_to_s3(uploads):
+    try:
+        async with anyio.create_task_group() as task_group:
+            for fileobj, object_key, content_type in uploads:
+                task_group.start_soon(upload_fileobj_to_s3, fileobj, object_key, content_type)
+    except BaseException:
+        await delete_images_from_s3([object_key for _, object_key, _ in uploads])
+        raise
+
+# Uploads the original image together with its resized variants.
+# Returns (object keys, original url, {variant name: url}).
+async def upload_image_to_s3(image):
     random_string = str(uuid4())
     unique_filename = f"{random_string}_{image.filename}"
-    image_url = f"https://{AWS_BUCKET}.s3.amazonaws.com/{unique_filename}"
-    s3.upload_fileobj(image.file, AWS_BUCKET, unique_filename, ExtraArgs={"ACL": "public-read", "ContentType": image.content_type})
-    return image_url
 
-def insert_image_data(cursor, image_filename, image_url, user_id):
-    insert_query = "INSERT INTO images (image_name, image_url, user_profile_id) VALUES (%s, %s, %s)"
-    cursor.execute(insert_query, (image_filename, image_url, user_id))
-    
-def update_image_data(cursor, image_filename, image_url, user_id):
-    update_image_query = "UPDATE images SET image_name = %s, image_url = %s WHERE user_profile_id = %s"
-    cursor.execute(update_image_query, (image_filename, image_url, user_id))
+    uploads, variant_urls = await render_image_variant_uploads(image.file, os.path.splitext(unique_filename)[0])
+    uploads.insert(0, (image.file, unique_filename, image.content_type))
+    variant_urls["original"] = s3_object_url(unique_filename)
+
+    await upload_files_to_s3(uploads)
+    return [object_key for _, object_key, _ in uploads], variant_urls["original"], variant_urls
+
+# Background step of a direct upload: fetches the confirmed original from S3,
+# uploads its variants and records them, unless the image was replaced meanwhile.
+async def add_image_variants(email, user_id, object_key):
+    object_keys = []
+    try:
+        with tempfile.SpooledTemporaryFile(max_size=S3_MULTIPART_CHUNK_SIZE) as original:
+            download = partial(get_s3().download_fileobj, AWS_BUCKET, object_key, original, Config=s3_transfer_config)
+            await anyio.to_thread.run_sync(download, limiter=s3_limiter)
+            uploads, variant_urls = await render_image_variant_uploads(original, os.path.splitext(object_key)[0])
+            object_keys = [key for _, key, _ in uploads]
+            await upload_files_to_s3(uploads)
+        variant_urls["original"] = s3_object_url(object_key)
+
+        async with pool.connection() as connection, connection.cursor() as cursor:
+            update_query = "UPDATE images SET variants = %s::jsonb WHERE user_profile_id = %s AND image_url = %s"
+            await cursor.execute(update_query, (dumps_json(variant_urls), user_id, variant_urls["original"]))
+            if cursor.rowcount == 0:
+                await connection.rollback()
+                await delete_images_from_s3(object_keys)
+                return
+            await touch_user_profile(cursor, user_id)
+            await record_profile_change(cursor, user_id, email, "image_updated")
+            await connection.commit()
+        profile_cache.invalidate(email)
+        pin_to_primary(email, user_id)
+
+    except Exception as e:
+        logger.error(f"Error creating variants for {object_key}: {e}")
+        if object_keys:
+            await delete_images_from_s3(object_keys)
+
+async def delete_images_from_s3(object_keys):
+    try:
+        delete = partial(get_s3().delete_objects, Bucket=AWS_BUCKET, Delete={"Objects": [{"Key": object_key} for object_key in object_keys]})
+        with observe_stage("s3", "delete"):
+            await anyio.to_thread.run_sync(delete, limiter=s3_limiter)
+        logger.info(f"Removed orphaned images {object_keys}")
+    except Exception as e:
+        logger.error(f"Error removing orphaned images {object_keys}: {e}")
+
+# A profile has a single image; a new upload replaces the previous one
+async def upsert_image_data(cursor, image_filename, image_url, variants, user_id):
+    upsert_query = """
+        INSERT INTO images (image_name, image_url, variants, user_profile_id) VALUES (%s, %s, %s::jsonb, %s)
+        ON CONFLICT (user_profile_id) DO UPDATE
+        SET image_name = EXCLUDED.image_name, image_url = EXCLUDED.image_url, variants = EXCLUDED.variants
+    """
+    await cursor.execute(upsert_query, (image_filename, image_url, dumps_json(variants), user_id), prepare=True)
     
-def get_images_for_users_profile(user_id, cursor):
-    cursor.execute("SELECT image_url FROM images WHERE user_profile_id = %s", (user_id,))
-    image_rows = cursor.fetchall()
-    images = [image[0] for image in image_rows]
-    return images
+# Bumps the profile version (and so its ETag) for changes made outside edit_user
+async def touch_user_profile(cursor, user_id):
+    await cursor.execute("UPDATE users_profile SET updated_at = now(), change_txid = pg_current_xact_id() WHERE user_id = %s", (user_id,), prepare=True)
+
+# A profile's ETag is derived from its updated_at version, exactly, so If-Match
+# can be turned back into it
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def profile_etag(updated_at):
+    return f'"{(updated_at - EPOCH) // timedelta(microseconds=1):x}"'
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or any(candidate.removeprefix("W/") == etag for candidate in candidates)
+
+# The updated_at a profile ETag was made from, or None if it isn't one of ours
+def etag_version(etag):
+    try:
+        microseconds = int(etag.strip().removeprefix("W/").strip('"'), 16)
+    except ValueError:
+        return None
+    return EPOCH + timedelta(microseconds=microseconds)
+
+def clean_interest_names(names):
+    return list(dict.fromkeys(name.strip() for name in names if name and name.strip()))
+
+# Gazetteer names are matched case-insensitively, ignoring surrounding spaces
+def normalize_locality(locality):
+    return locality.strip().lower()
+
+def read_gazetteer(path=GAZETTEER_PATH):
+    with open(path, newline="", encoding="utf-8") as gazetteer_file:
+        return {
+            normalize_locality(row["name"]): (float(row["latitude"]), float(row["longitude"]))
+            for row in csv.DictReader(gazetteer_file)
+        }
+
+GAZETTEER = read_gazetteer()
+
+# Upserts the bundled gazetteer into the localities table. Profiles already
+# geocoded keep their location until their locality is written again.
+async def load_gazetteer(cursor):
+    gazetteer = read_gazetteer()
+    await cursor.execute("""
+        INSERT INTO localities (name, latitude, longitude)
+        SELECT * FROM unnest(%s::text[], %s::float8[], %s::float8[])
+        ON CONFLICT (name) DO UPDATE SET latitude = EXCLUDED.latitude, longitude = EXCLUDED.longitude
+    """, (
+        list(gazetteer),
+        [latitude for latitude, _ in gazetteer.values()],
+        [longitude for _, longitude in gazetteer.values()],
+    ))
+
+def geocode_locality(locality):
+    return GAZETTEER.get(normalize_locality(locality))
+
+# (min_longitude, min_latitude, max_longitude, max_latitude) of a box holding
+# every point within radius_km. Near a pole or across the antimeridian it
+# widens to every longitude rather than wrapping.
+def bounding_box(latitude, longitude, radius_km):
+    latitude_delta = radius_km / KM_PER_DEGREE_LATITUDE
+    min_latitude = latitude - latitude_delta
+    max_latitude = latitude + latitude_delta
+    if min_latitude <= -90 or max_latitude >= 90:
+        return -180.0, max(min_latitude, -90.0), 180.0, min(max_latitude, 90.0)
+
+    longitude_delta = latitude_delta / math.cos(math.radians(max(abs(min_latitude), abs(max_latitude))))
+    if longitude - longitude_delta < -180 or longitude + longitude_delta > 180:
+        return -180.0, min_latitude, 180.0, max_latitude
+    return longitude - longitude_delta, min_latitude, longitude + longitude_delta, max_latitude
+
+def profile_cache_headers(etag):
+    return {"ETag": etag, "Cache-Control": PROFILE_CACHE_CONTROL}
+
+def not_modified_response(etag):
+    return Response(status_code=304, headers=profile_cache_headers(etag))
+
+# Appends the change to the profile_changes outbox in the surrounding transaction.
+# The notification is delivered to every worker's listener when it commits.
+async def record_profile_change(cursor, user_id, email, operation):
+    await cursor.execute("""
+        WITH change AS (
+            INSERT INTO profile_changes (user_id, email, operation) VALUES (%s, %s, %s)
+        )
+        SELECT pg_notify(%s, json_build_object('email', %s::text, 'user_id', %s::text)::text)
+    """, (user_id, email, operation, PROFILE_CHANGES_CHANNEL, email, user_id), prepare=True)
+
+# Change feed position: the writing transaction's id and the change id.
+# Feed order is commit-safe: only changes of transactions older than every
+# one still running are returned, so a slow transaction can't commit a
+# change behind a position a consumer has already read past.
+def encode_change_cursor(txid, change_id):
+    return f"{txid}-{change_id}"
+
+def decode_change_cursor(cursor):
+    if not cursor:
+        return 0, 0
+    txid, _, change_id = cursor.partition("-")
+    return int(txid), int(change_id)
+
+async def fetch_profile_changes(connection, since, limit):
+    txid, change_id = since
+    async with connection.cursor(row_factory=dict_row) as cursor:
+        await cursor.execute("""
+            SELECT change_id, txid::text AS txid, user_id, email, operation, changed_at
+            FROM profile_changes
+            WHERE (txid, change_id) > (%s::text::xid8, %s)
+              AND txid < pg_snapshot_xmin(pg_current_snapshot())
+            ORDER BY txid, change_id
+            LIMIT %s
+        """, (txid, change_id, limit), prepare=True)
+        rows = await cursor.fetchall()
+    # Reading the snapshot leaves a transaction open on the pooled connection
+    await connection.commit()
+
+    changes = []
+    for row in rows:
+        position = encode_change_cursor(row.pop("txid"), row.pop("change_id"))
+        changes.append({"cursor": position, **row})
+    return changes
+
+# Position of the newest visible change, where a new tail starts
+async def latest_profile_change_position(connection):
+    async with connection.cursor() as cursor:
+        await cursor.execute("""
+            SELECT txid::text, change_id
+            FROM profile_changes
+            WHERE txid < pg_snapshot_xmin(pg_current_snapshot())
+            ORDER BY txid DESC, change_id DESC
+            LIMIT 1
+        """)
+        row = await cursor.fetchone()
+    await connection.commit()
+    return (int(row[0]), row[1]) if row else (0, 0)
+
+# Whether changes after since were pruned, so a consumer there has missed some
+async def profile_changes_expired(connection, since):
+    txid, change_id = since
+    async with connection.cursor() as cursor:
+        await cursor.execute("""
+            SELECT EXISTS (
+                SELECT 1 FROM profile_changes_horizon WHERE (txid, change_id) > (%s::text::xid8, %s)
+            )
+        """, (txid, change_id), prepare=True)
+        return (await cursor.fetchone())[0]
+
+# The worker's one reader of the outbox for its change streams. Woken by the
+# listener, and every poll interval besides, since a committed change only
+# becomes visible once the transactions older than it have finished.
+async def follow_profile_changes():
+    while True:
+        profile_changes_notified.clear()
+        try:
+            async with pool.connection() as connection:
+                if profile_change_tail.start is None:
+                    profile_change_tail.reset(await latest_profile_change_position(connection))
+                changes = await fetch_profile_changes(connection, profile_change_tail.end(), PROFILE_CHANGES_PAGE_MAX_SIZE)
+            if changes:
+                profile_change_tail.extend(changes)
+                for waiter in profile_change_waiters:
+                    waiter.set()
+                if len(changes) == PROFILE_CHANGES_PAGE_MAX_SIZE:
+                    continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            logger.error(f"Error following profile changes: {error}")
+        try:
+            await asyncio.wait_for(profile_changes_notified.wait(), PROFILE_CHANGES_STREAM_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+# Drops changes older than the retention period, so the outbox doesn't grow
+# without bound, and moves the horizon up to the newest change dropped
+async def prune_profile_changes():
+    while True:
+        try:
+            async with pool.connection() as connection:
+                await connection.execute("""
+                    WITH pruned AS (
+                        DELETE FROM profile_changes
+                        WHERE changed_at < now() - make_interval(secs => %s)
+                        RETURNING txid, change_id
+                    )
+                    INSERT INTO profile_changes_horizon AS horizon (id, txid, change_id)
+                    SELECT true, txid, change_id FROM pruned
+                    ORDER BY txid DESC, change_id DESC
+                    LIMIT 1
+                    ON CONFLICT (id) DO UPDATE SET txid = EXCLUDED.txid, change_id = EXCLUDED.change_id
+                    WHERE (EXCLUDED.txid, EXCLUDED.change_id) > (horizon.txid, horizon.change_id)
+                """, (PROFILE_CHANGES_RETENTION,))
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            logger.error(f"Error pruning profile changes: {error}")
+        await asyncio.sleep(PROFILE_CHANGES_PRUNE_INTERVAL)
     
@@ -0,0 +1,20 @@
+import asyncio
+import psycopg
+from main import get_conninfo, migrate
+
+# Applies pending schema migrations. Run it as a release step before rolling out
+# pods started with DB_MIGRATE_ON_STARTUP=false.
+# Usage: python migrate.py
+
+
+async def run_migrations():
+    async with await psycopg.AsyncConnection.connect(get_conninfo()) as connection:
+        await migrate(connection)
+
+
+def main():
+    asyncio.run(run_migrations())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import math, os, tempfile
+import uvicorn
+
+# Production entry point: runs main:app in one uvicorn worker process per
+# available core, or WEB_CONCURRENCY of them. Every worker has its own pools,
+# cache and background tasks, and takes a 1/WEB_CONCURRENCY share of
+# DB_MAX_CONNECTIONS for its pool.
+# Usage: python serve.py
+
+
+def available_cpu_count():
+    # The cores this process may run on, not the host's
+    if hasattr(os, "sched_getaffinity"):
+        count = len(os.sched_getaffinity(0))
+    else:
+        count = os.cpu_count() or 1
+    # A CPU quota (docker run --cpus) caps it further
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as cpu_max:
+            quota, period = cpu_max.read().split()
+        if quota != "max":
+            count = min(count, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return count
+
+
+def main():
+    workers = int(os.getenv("WEB_CONCURRENCY") or available_cpu_count())
+    # Inherited by the workers, which size their pools from it
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    # Where the workers write their metrics, so /metrics reports all of them
+    if workers > 1 and not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="prometheus-")
+
+    uvicorn.run(
+        "main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8001")),
+        workers=workers,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,18 @@
 import pytest
+import asyncio
+import io
+import json
+import boto3
+import requests
+from moto import mock_aws
+import math
+from PIL import Image
 from uuid import uuid4
+from datetime import datetime, timezone
 from fastapi.testclient import TestClient
-from unittest.mock import patch, MagicMock
-from main import app, connect_db
+import main
+from unittest.mock import patch, MagicMock, AsyncMock
+from main import app, connect_db, migrate, MIGRATIONS, start_db, profile_cache, ProfileCache, sync_user_interests, profile_etag, check_replica, get_read_pool, pin_to_primary, encode_change_cursor, decode_change_cursor, profile_change_events, etag_version, geocode_locality, bounding_box
 
 
 @pytest.fixture
@@ -11,15 +21,28 @@ def test_client():
 
 @pytest.fixture
 def mock_db_connection():
-    with patch('main.psycopg2.connect') as mock_connect:
-        mock_connection = MagicMock()
-        mock_cursor = MagicMock()
+    mock_connection = AsyncMock()
+    mock_connection.cursor = MagicMock()
+    mock_cursor = AsyncMock()
 
-        mock_cursor.__enter__.return_value = mock_cursor
+    mock_cursor.__aenter__.return_value = mock_cursor
+    mock_connection.cursor.return_value = mock_cursor
+    mock_connection.transaction = MagicMock()
+
+    yield mock_connection, mock_cursor
 
-        mock_connect.return_value = mock_connection
+@pytest.fixture
+def mock_db_pool(mock_db_connection):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_pool = MagicMock()
+    mock_pool.open = AsyncMock()
+    mock_pool.close = AsyncMock()
+    mock_pool.connection.return_value.__aenter__.return_value = mock_connection
 
-        yield mock_connection, mock_cursor 
+    with patch('main.AsyncConnectionPool') as mock_pool_class:
+        mock_pool_class.return_value = mock_pool
+        mock_pool_class.check_connection = AsyncMock()
+        yield mock_pool
         
 @pytest.fixture(autouse=True)
 def reset_mocks(mock_db_connection):
@@ -28,15 +51,25 @@ def reset_mocks(mock_db_connection):
     
     # Reset the mock_cursor as well
     mock_cursor.reset_mock()
+    profile_cache.clear()
     yield
 
-def test_connect_db_success(mock_db_connection):
+def test_connect_db_success(mock_db_connection, mock_db_pool):
     mock_connection, mock_cursor = mock_db_connection
     mock_connection.cursor.return_value = mock_cursor
 
-    result = connect_db()
+    result = asyncio.run(connect_db())
 
     assert result is True
+    mock_db_pool.open.assert_awaited_once()
+
+def test_connect_db_failure(mock_db_pool):
+    mock_db_pool.open.side_effect = Exception("Simulated connection error")
+
+    result = asyncio.run(connect_db())
+
+    assert result is False
+    mock_db_pool.close.assert_awaited_once()
 
 def test_health(test_client):
 
@@ -51,7 +84,7 @@ def test_health(test_client):
     # You dont even need to pass them in formData, for default it will be passed as None if there is no value passed in formData
     ("TestUser", "testuser123@gmail.com", None, None, None, None, 200, "User Profile created successfully!"),
 ])
-def test_create_profile_success(test_client, username, email, locality, first_name, last_name, description,expected_status_code, expected_message, mock_db_connection):
+def test_create_profile_success(test_client, username, email, locality, first_name, last_name, description,expected_status_code, expected_message, mock_db_connection, mock_db_pool):
     mock_connection, mock_cursor = mock_db_connection
 
     form_data = {
@@ -63,10 +96,10 @@ def test_create_profile_success(test_client, username, email, locality, first_na
         "description": description
     }
     
-    mock_cursor.fetchone.return_value = None  # Ensure that the user does not exist
+    mock_cursor.fetchone.return_value = (str(uuid4()),)  # The insert went through, so the user did not exist
     mock_connection.cursor.return_value = mock_cursor
     
-    with patch('main.connection', mock_connection):
+    with patch('main.pool', mock_db_pool):
         response = test_client.post("/profile/", data=form_data)
     
 
@@ -77,7 +110,8 @@ def test_create_profile_success(test_client, username, email, locality, first_na
 @pytest.mark.parametrize("username, email, locality, first_name, last_name, description, expected_status_code, expected_detail", [
     ("TestUser", "testuser@gmail.com", None, None, None, None, 400, "User already exists"),
 ])
-def test_create_profile_failure(test_client, username, email, locality, first_name, last_name, description,expected_status_code, expected_detail):
+def test_create_profile_failure(test_client, username, email, locality, first_name, last_name, description,expected_status_code, expected_detail, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
 
     form_data = {
         "username": username,
@@ -88,10 +122,17 @@ def test_create_profile_failure(test_client, username, email, locality, first_na
         "description": description
     }
 
-    response = test_client.post("/profile/", data=form_data)
+    mock_cursor.fetchone.return_value = None  # ON CONFLICT skipped the insert, the user already exists
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.post("/profile/", data=form_data)
 
     assert response.json()['status_code'] == expected_status_code
     assert response.json()['detail'] == expected_detail
+    # The conflict is detected by the insert itself, with no separate existence check
+    mock_cursor.execute.assert_awaited_once()
+    assert "ON CONFLICT (email) DO NOTHING" in mock_cursor.execute.call_args[0][0]
+    mock_connection.commit.assert_not_awaited()
 
 
 @pytest.mark.parametrize("email, locality, first_name, last_name, description, interests, image, expected_status_code, expected_message", [
@@ -108,7 +149,8 @@ def test_create_profile_failure(test_client, username, email, locality, first_na
     ("testuser@gmail.com", 'Aveiro', None, None, "Animal's Lover", "Dogs,Cats", None, 200, "User Profile updated successfully!"),
     ("testuser@gmail.com", None, None, None, None, None, None, 200, "User Profile updated successfully!"),
 ])
-def test_edit_profile_success(test_client, email, locality, first_name, last_name, description, interests, image, expected_status_code, expected_message):
+def test_edit_profile_success(test_client, email, locality, first_name, last_name, description, interests, image, expected_status_code, expected_message, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
 
     form_data = {
         "locality": locality,
@@ -119,13 +161,197 @@ def test_edit_profile_success(test_client, email, locality, first_name, last_nam
         
     }
     
-    response = test_client.put(f"/profile/{email}", data=form_data, files=image)
+    mock_cursor.fetchone.return_value = {"user_id": uuid4(), "previous_locality": None}
+    mock_cursor.fetchall.return_value = []
+
+    with patch('main.pool', mock_db_pool), patch('main.s3'):
+        response = test_client.put(f"/profile/{email}", data=form_data, files=image)
 
     assert response.status_code == expected_status_code
     assert response.json()['message'] == expected_message
 
 
-def test_edit_profile_user_not_found(test_client, mock_db_connection):
+def png_image(width, height):
+    buffer = io.BytesIO()
+    Image.new("RGBA", (width, height), (200, 120, 40, 255)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def mock_s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with mock_aws():
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket="test-bucket")
+        with patch('main.s3', s3), patch('main.AWS_BUCKET', "test-bucket"):
+            yield s3
+
+
+def test_edit_profile_uploads_image_to_s3(test_client, mock_db_connection, mock_db_pool, mock_s3):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.fetchone.return_value = {"user_id": uuid4(), "previous_locality": None}
+    mock_cursor.fetchall.return_value = []
+
+    files = {"image": ("Profile.png", png_image(1600, 1200), "image/png")}
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.put("/profile/testuser@gmail.com", data={"interests": "Dogs"}, files=files)
+
+    assert response.json()['message'] == "User Profile updated successfully!"
+    keys = sorted(item["Key"].split("_", 1)[1] for item in mock_s3.list_objects_v2(Bucket="test-bucket")["Contents"])
+    assert keys == [
+        "Profile.png",
+        "Profile_medium.jpg",
+        "Profile_medium_webp.webp",
+        "Profile_original_webp.webp",
+        "Profile_thumbnail.jpg",
+        "Profile_thumbnail_webp.webp",
+    ]
+    mock_connection.commit.assert_awaited_once()
+
+    # The variant URLs are stored with the image row
+    upsert_params = next(call[0][1] for call in mock_cursor.execute.call_args_list if "INSERT INTO images" in call[0][0])
+    variants = json.loads(upsert_params[2])
+    assert set(variants) == {"original", "thumbnail", "thumbnail_webp", "medium", "medium_webp", "original_webp"}
+
+    thumbnail_key = variants["thumbnail"].rsplit("/", 1)[1]
+    thumbnail = Image.open(io.BytesIO(mock_s3.get_object(Bucket="test-bucket", Key=thumbnail_key)["Body"].read()))
+    assert thumbnail.format == "JPEG"
+    assert max(thumbnail.size) == 128
+
+
+def test_edit_profile_rejects_invalid_image(test_client, mock_db_connection, mock_db_pool, mock_s3):
+    files = {"image": ("Profile.png", b"not an image", "image/png")}
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.put("/profile/testuser@gmail.com", data={"interests": "Dogs"}, files=files)
+
+    assert response.json()['status_code'] == 400
+    assert mock_s3.list_objects_v2(Bucket="test-bucket")["KeyCount"] == 0
+    # Rejected before a connection was ever checked out
+    mock_db_pool.connection.assert_not_called()
+
+
+@pytest.mark.parametrize("limit, expected_status_code", [
+    ({"IMAGE_UPLOAD_MAX_BYTES": 100}, 413),
+    # 64x64 is over the pixel limit: rejected as a decompression bomb
+    ({"IMAGE_MAX_PIXELS": 1000}, 400),
+])
+def test_edit_profile_rejects_oversized_image(test_client, limit, expected_status_code, mock_db_connection, mock_db_pool, mock_s3):
+    (name, value), = limit.items()
+    files = {"image": ("Profile.png", png_image(64, 64), "image/png")}
+
+    with patch('main.pool', mock_db_pool), patch(f'main.{name}', value):
+        response = test_client.put("/profile/testuser@gmail.com", data={"interests": "Dogs"}, files=files)
+
+    assert response.json()['status_code'] == expected_status_code
+    assert mock_s3.list_objects_v2(Bucket="test-bucket")["KeyCount"] == 0
+    mock_db_pool.connection.assert_not_called()
+
+
+def test_image_variants_are_resized_from_the_previous_one():
+    with patch.object(Image.Image, "copy", side_effect=AssertionError("full-size copy")):
+        rendered = main.render_image_variants(io.BytesIO(png_image(1600, 1200)))
+
+    sizes = {name: Image.open(io.BytesIO(data)).size for name, _, _, data in rendered}
+    assert sizes == {
+        "original_webp": (1600, 1200),
+        "medium": (640, 480),
+        "medium_webp": (640, 480),
+        "thumbnail": (128, 96),
+        "thumbnail_webp": (128, 96),
+    }
+
+
+def test_edit_profile_checks_out_connection_after_upload(test_client, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.fetchone.return_value = {"user_id": uuid4(), "previous_locality": None}
+    mock_cursor.fetchall.return_value = []
+
+    async def upload_image_to_s3(image):
+        mock_db_pool.connection.assert_not_called()
+        return ["uploads/Profile.png"], "https://example.com/Profile.png", {}
+
+    files = {"image": ("Profile.png", png_image(64, 64), "image/png")}
+    with patch('main.pool', mock_db_pool), patch('main.upload_image_to_s3', upload_image_to_s3):
+        response = test_client.put("/profile/testuser@gmail.com", data={"interests": "Dogs"}, files=files)
+
+    assert response.json()['message'] == "User Profile updated successfully!"
+    mock_db_pool.connection.assert_called_once()
+
+
+def test_edit_profile_removes_image_when_commit_fails(test_client, mock_db_connection, mock_db_pool, mock_s3):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.fetchone.return_value = {"user_id": uuid4(), "previous_locality": None}
+    mock_cursor.fetchall.return_value = []
+    mock_connection.commit.side_effect = Exception("Simulated commit error")
+
+    files = {"image": ("Profile.png", png_image(64, 64), "image/png")}
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.put("/profile/testuser@gmail.com", data={"interests": "Dogs"}, files=files)
+
+    assert response.json()['status_code'] == 500
+    assert mock_s3.list_objects_v2(Bucket="test-bucket")["KeyCount"] == 0
+    mock_connection.rollback.assert_awaited_once()
+
+
+def test_direct_image_upload(test_client, mock_db_connection, mock_db_pool, mock_s3):
+    mock_connection, mock_cursor = mock_db_connection
+    user_id = str(uuid4())
+    mock_cursor.fetchone.return_value = (user_id,)
+    mock_cursor.rowcount = 1
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.post("/profile/testuser@gmail.com/image/upload-url", data={"content_type": "image/png", "filename": "Profile.png"})
+        upload = response.json()
+
+        assert upload["key"].startswith(f"uploads/{user_id}/")
+        assert upload["fields"]["Content-Type"] == "image/png"
+
+        # The client sends the bytes straight to S3
+        requests.post(upload["url"], data=upload["fields"], files={"file": ("Profile.png", png_image(800, 600))}).raise_for_status()
+
+        response = test_client.post("/profile/testuser@gmail.com/image/confirm", data={"key": upload["key"]})
+
+    assert response.json()["message"] == "User Profile image updated successfully!"
+    upsert_params = next(call[0][1] for call in mock_cursor.execute.call_args_list if "INSERT INTO images" in call[0][0])
+    assert upsert_params[0] == "Profile.png"
+    assert upsert_params[3] == user_id
+
+    # Variants were generated in the background and recorded on the image row
+    keys = [item["Key"] for item in mock_s3.list_objects_v2(Bucket="test-bucket")["Contents"]]
+    assert len(keys) == 6
+    update_params = next(call[0][1] for call in mock_cursor.execute.call_args_list if "UPDATE images SET variants" in call[0][0])
+    assert set(json.loads(update_params[0])) == {"original", "thumbnail", "thumbnail_webp", "medium", "medium_webp", "original_webp"}
+
+
+@pytest.mark.parametrize("key, content_type, expected_status_code", [
+    ("uploads/{other_user_id}/image.png", "image/png", 403),
+    ("uploads/{user_id}/image.txt", "text/plain", 400),
+    ("uploads/{user_id}/missing.png", None, 404),
+])
+def test_confirm_image_upload_rejected(test_client, key, content_type, expected_status_code, mock_db_connection, mock_db_pool, mock_s3):
+    mock_connection, mock_cursor = mock_db_connection
+    user_id = str(uuid4())
+    mock_cursor.fetchone.return_value = (user_id,)
+
+    key = key.format(user_id=user_id, other_user_id=uuid4())
+    if content_type:
+        mock_s3.put_object(Bucket="test-bucket", Key=key, Body=b"data", ContentType=content_type)
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.post("/profile/testuser@gmail.com/image/confirm", data={"key": key})
+
+    assert response.json()["status_code"] == expected_status_code
+    mock_connection.commit.assert_not_awaited()
+    # Only the ownership lookup checked out a connection, and it was returned idle
+    mock_db_pool.connection.assert_called_once()
+    mock_connection.set_autocommit.assert_awaited_with(False)
+
+
+def test_edit_profile_user_not_found(test_client, mock_db_connection, mock_db_pool):
     
     mock_connection, mock_cursor = mock_db_connection
     mock_cursor.fetchone.return_value = None
@@ -142,14 +368,178 @@ def test_edit_profile_user_not_found(test_client, mock_db_connection):
 
     mock_connection.cursor.return_value = mock_cursor
 
-    with patch('main.connection', mock_connection):
+    with patch('main.pool', mock_db_pool):
         response = test_client.put(f"/profile/{email}", data=form_data)
     
     assert response.json()['status_code'] == 404
     assert response.json()['detail'] == "User not found"    
 
     
-def test_get_user_profile(test_client, mock_db_connection):
+@pytest.mark.parametrize("filename, content", [
+    ("profiles.csv", b"username,email,locality\nuser1,user1@example.com,Aveiro\nuser2,,Porto\nuser3,user3@example.com,\n"),
+    ("profiles.ndjson", b'{"username": "user1", "email": "user1@example.com", "locality": "Aveiro"}\n{"username": "user2", "locality": "Porto"}\n{"username": "user3", "email": "user3@example.com"}\n'),
+])
+def test_import_users(test_client, filename, content, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+
+    mock_copy = AsyncMock()
+    mock_cursor.copy = MagicMock()
+    mock_cursor.copy.return_value.__aenter__.return_value = mock_copy
+    # user3 already has a profile
+    line = 4 if filename.endswith(".csv") else 3
+    mock_cursor.fetchall.return_value = [(line, "user3@example.com")]
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.post("/profile/import", files={"file": (filename, content)})
+
+    assert response.json() == {
+        "inserted": 1,
+        "conflicts": [{"line": line, "email": "user3@example.com"}],
+        "invalid": [{"line": line - 1, "error": "username and email are required"}],
+    }
+    written_rows = [call[0][0] for call in mock_copy.write_row.call_args_list]
+    assert written_rows == [
+        [line - 2, "user1", "user1@example.com", "Aveiro", None, None, None],
+        [line, "user3", "user3@example.com", None, None, None, None],
+    ]
+    mock_connection.commit.assert_awaited_once()
+
+    # The staging table is analyzed before the upsert reads it
+    queries = [call[0][0] for call in mock_cursor.execute.call_args_list]
+    analyze = queries.index("ANALYZE users_profile_import")
+    upsert = next(i for i, query in enumerate(queries) if "INSERT INTO users_profile " in query)
+    assert analyze < upsert
+    assert "NOT EXISTS" in queries[upsert]
+
+
+@pytest.mark.parametrize("export_format, expected_body", [
+    ("ndjson", '{"user_id":"1","email":"user1@example.com","interests":[{"interest":"Dogs"}],"image":[],"updated_at":"2024-01-01T00:00:00+00:00"}\n'
+               '{"user_id":"2","email":"user2@example.com","interests":[],"image":["https://bucket/2.png"],"updated_at":"2024-01-02T00:00:00+00:00"}\n'),
+    ("csv", 'user_id,email,interests,image,updated_at\r\n'
+            '1,user1@example.com,"[{""interest"":""Dogs""}]",[],2024-01-01T00:00:00+00:00\r\n'
+            '2,user2@example.com,[],"[""https://bucket/2.png""]",2024-01-02T00:00:00+00:00\r\n'),
+])
+def test_export_users(test_client, export_format, expected_body, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+
+    rows = [
+        {"user_id": "1", "email": "user1@example.com", "interests": [{"interest": "Dogs"}], "image": [], "updated_at": datetime(2024, 1, 1, tzinfo=timezone.utc)},
+        {"user_id": "2", "email": "user2@example.com", "interests": [], "image": ["https://bucket/2.png"], "updated_at": datetime(2024, 1, 2, tzinfo=timezone.utc)},
+    ]
+    # Rows come back from the server-side cursor one chunk at a time
+    mock_cursor.fetchmany.side_effect = [rows[:1], rows[1:], []]
+    # Oldest transaction still running when the export starts
+    mock_cursor.fetchone.return_value = ("1000",)
+
+    with patch('main.pool', mock_db_pool), patch('main.EXPORT_COLUMNS', ("user_id", "email", "interests", "image", "updated_at")):
+        response = test_client.get("/profile/export", params={"format": export_format, "since": 990})
+
+    assert response.status_code == 200
+    assert response.text == expected_body
+    assert response.headers["X-Export-Watermark"] == "1000"
+    assert mock_connection.cursor.call_args.kwargs["name"] == "profile_export"
+    query, params = mock_cursor.execute.call_args[0]
+    # Changes from since= up to, but not including, transactions still running
+    assert "p.change_txid < %s::text::xid8" in query
+    assert "p.change_txid >= %s::text::xid8" in query
+    assert params == ("1000", "990")
+
+
+def test_search_users(test_client, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+
+    results = [
+        {"user_id": str(uuid4()), "username": "johnny", "email": "johnny@example.com", "locality": "Aveiro", "first_name": "John", "last_name": "Doe", "rank": 0.9},
+        {"user_id": str(uuid4()), "username": "jo", "email": "jo@example.com", "locality": "Aveiro", "first_name": "Joana", "last_name": "Silva", "rank": 0.4},
+        {"user_id": str(uuid4()), "username": "jonas", "email": "jonas@example.com", "locality": "Aveiro", "first_name": "Jonas", "last_name": "Lee", "rank": 0.2},
+    ]
+    mock_cursor.fetchall.return_value = results
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.get("/profile/search", params={"q": "Jo D", "locality": "Aveiro", "interest": "Dogs", "limit": 2})
+
+    assert response.status_code == 200
+    assert response.json() == results[:2]
+    assert response.headers["X-Next-Offset"] == "2"
+
+    query, params = mock_cursor.execute.call_args[0]
+    assert "p.locality = %s" in query and "p.interests @> %s::jsonb" in query
+    assert params[:4] == ["jo d", "jo:* & d:*", "jo d", "Aveiro"]
+    assert json.loads(params[4]) == [{"interest": "Dogs"}]
+    assert params[5:] == [3, 0]
+
+
+def test_search_users_without_words(test_client, mock_db_pool):
+    with patch('main.pool', mock_db_pool):
+        response = test_client.get("/profile/search", params={"q": "!!!"})
+
+    assert response.json() == []
+
+
+def test_nearby_users(test_client, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+
+    results = [
+        {"user_id": str(uuid4()), "username": "ana", "email": "ana@example.com", "locality": "Aveiro", "first_name": "Ana", "last_name": "Silva", "distance_km": 0.0},
+        {"user_id": str(uuid4()), "username": "rui", "email": "rui@example.com", "locality": "Ílhavo", "first_name": "Rui", "last_name": "Costa", "distance_km": 5.8},
+        {"user_id": str(uuid4()), "username": "eva", "email": "eva@example.com", "locality": "Águeda", "first_name": "Eva", "last_name": "Lopes", "distance_km": 19.2},
+    ]
+    mock_cursor.fetchall.return_value = results
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.get("/profile/nearby", params={"locality": " aveiro", "radius_km": 30, "interest": "Dogs", "limit": 2})
+
+    assert response.status_code == 200
+    assert response.json() == results[:2]
+    assert response.headers["X-Next-Offset"] == "2"
+
+    query, params = mock_cursor.execute.call_args[0]
+    assert "p.location <@ box(point(%s, %s), point(%s, %s))" in query and "p.interests @> %s::jsonb" in query
+    latitude, longitude = geocode_locality("Aveiro")
+    assert params[:3] == [latitude, latitude, longitude]
+    assert params[3:7] == list(bounding_box(latitude, longitude, 30))
+    assert json.loads(params[7]) == [{"interest": "Dogs"}]
+    assert params[8:] == [30, 3, 0]
+
+
+@pytest.mark.parametrize("params", [
+    {"locality": "Atlantis"},
+    {"latitude": 40.6},
+    {},
+])
+def test_nearby_users_needs_a_known_origin(test_client, params, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.get("/profile/nearby", params=params)
+
+    assert response.json()["status_code"] == 400
+    mock_cursor.execute.assert_not_called()
+
+
+@pytest.mark.parametrize("latitude, longitude, radius_km", [
+    (40.6405, -8.6538, 25),
+    (-33.9, 151.2, 500),
+    (70.0, 179.5, 100),
+    (89.9, 0.0, 50),
+])
+def test_bounding_box_holds_the_whole_radius(latitude, longitude, radius_km):
+    min_longitude, min_latitude, max_longitude, max_latitude = bounding_box(latitude, longitude, radius_km)
+
+    # Walk the circle and check every point on it is inside the box
+    distance = radius_km / main.EARTH_RADIUS_KM
+    for step in range(360):
+        bearing = math.radians(step)
+        lat1, lon1 = math.radians(latitude), math.radians(longitude)
+        lat2 = math.asin(math.sin(lat1) * math.cos(distance) + math.cos(lat1) * math.sin(distance) * math.cos(bearing))
+        lon2 = lon1 + math.atan2(math.sin(bearing) * math.sin(distance) * math.cos(lat1), math.cos(distance) - math.sin(lat1) * math.sin(lat2))
+        point_latitude = math.degrees(lat2)
+        point_longitude = (math.degrees(lon2) + 540) % 360 - 180
+        assert min_latitude - 1e-9 <= point_latitude <= max_latitude + 1e-9
+        assert min_longitude - 1e-9 <= point_longitude <= max_longitude + 1e-9
+
+
+def test_get_user_profile(test_client, mock_db_connection, mock_db_pool):
     
     mock_connection, mock_cursor = mock_db_connection
 
@@ -168,14 +558,15 @@ def test_get_user_profile(test_client, mock_db_connection):
                 "interest": "Cat"
             }
         ],
-        "image": []
+        "image": [],
+        "updated_at": datetime(2024, 1, 1, tzinfo=timezone.utc)
     }
 
-    mock_cursor.fetchone.return_value = tuple(user_profile.values())
+    mock_cursor.fetchone.return_value = user_profile
     mock_cursor.fetchall.return_value = []
     mock_connection.cursor.return_value = mock_cursor
 
-    with patch('main.connection', mock_connection):
+    with patch('main.pool', mock_db_pool):
 
         response = test_client.get(f"/profile/{email}")
 
@@ -189,10 +580,118 @@ def test_get_user_profile(test_client, mock_db_connection):
         "last_name": user_profile["last_name"],
         "description": user_profile["description"],
         "interests": user_profile["interests"],
-        "image": user_profile["image"]
-    }    
+        "image": user_profile["image"],
+        "updated_at": "2024-01-01T00:00:00+00:00"
+    }
+    assert response.headers["ETag"]
+    assert response.headers["Cache-Control"]
+    # Profile and images come back from a single statement
+    mock_cursor.execute.assert_awaited_once()
+
+
+def test_get_user_profile_not_modified(test_client, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+    email = "test@example.com"
+    updated_at = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    mock_cursor.fetchone.return_value = {"updated_at": updated_at}
+    etag = profile_etag(updated_at)
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.get(f"/profile/{email}", headers={"If-None-Match": f'W/{etag}'})
+
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    # Only the version lookup ran, not the profile and images query
+    mock_cursor.execute.assert_awaited_once()
+    assert mock_cursor.execute.call_args[0][0] == "SELECT updated_at FROM users_profile WHERE email = %s"
+
+
+def test_get_user_profile_changed_since_etag(test_client, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+    email = "test@example.com"
+    updated_at = datetime(2024, 1, 2, tzinfo=timezone.utc)
+
+    user_profile = {"user_id": str(uuid4()), "email": email, "image": [], "updated_at": updated_at}
+    mock_cursor.fetchone.side_effect = [{"updated_at": updated_at}, user_profile]
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.get(f"/profile/{email}", headers={"If-None-Match": profile_etag(datetime(2024, 1, 1, tzinfo=timezone.utc))})
+
+    assert response.status_code == 200
+    assert response.json()["email"] == email
+    assert response.headers["ETag"] == profile_etag(updated_at)
     
-def test_get_user_profile_not_found(test_client, mock_db_connection):
+def test_get_user_profile_is_cached_until_edited(test_client, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+    email = "cached@example.com"
+
+    mock_cursor.fetchone.return_value = {
+        "user_id": str(uuid4()),
+        "username": "test_user",
+        "email": email,
+        "locality": "Aveiro",
+        "first_name": "John",
+        "last_name": "Doe",
+        "description": "User description",
+        "interests": [],
+        "image": [],
+        "updated_at": datetime(2024, 1, 1, tzinfo=timezone.utc)
+    }
+    mock_cursor.fetchall.return_value = []
+
+    with patch('main.pool', mock_db_pool), patch('main.profile_cache', ProfileCache(max_size=10, ttl=60)):
+        first = test_client.get(f"/profile/{email}")
+        second = test_client.get(f"/profile/{email}")
+
+        assert first.json() == second.json()
+        assert mock_db_pool.connection.call_count == 1
+
+        # Revalidation against the cached copy doesn't touch the database either
+        not_modified = test_client.get(f"/profile/{email}", headers={"If-None-Match": first.headers["ETag"]})
+        assert not_modified.status_code == 304
+        assert mock_db_pool.connection.call_count == 1
+
+        user_profile = mock_cursor.fetchone.return_value
+        mock_cursor.fetchone.return_value = {"user_id": user_profile["user_id"], "previous_locality": "Aveiro"}
+        response = test_client.put(f"/profile/{email}", data={"locality": "Porto"})
+        assert response.json()['message'] == "User Profile updated successfully!"
+
+        mock_cursor.fetchone.return_value = user_profile
+
+        test_client.get(f"/profile/{email}")
+        assert mock_db_pool.connection.call_count == 3
+
+        stats = test_client.get("/profile/cache/stats").json()
+        assert stats["hits"] == 2
+        assert stats["misses"] == 2
+
+
+def test_profile_cache_evicts_least_recently_used():
+    cache = ProfileCache(max_size=2, ttl=60)
+
+    cache.set("a", 1, cache.version)
+    cache.set("b", 2, cache.version)
+    cache.get("a")
+    cache.set("c", 3, cache.version)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_profile_cache_skips_reads_that_raced_an_invalidation():
+    cache = ProfileCache(max_size=10, ttl=60)
+
+    version = cache.version
+    cache.invalidate("a")
+    cache.set("a", "stale", version)
+
+    assert cache.get("a") is None
+
+
+def test_get_user_profile_not_found(test_client, mock_db_connection, mock_db_pool):
     mock_connection, mock_cursor = mock_db_connection
     email = "nonexistent@gmail.com"
 
@@ -200,14 +699,56 @@ def test_get_user_profile_not_found(test_client, mock_db_connection):
     mock_cursor.fetchall.return_value = []
     mock_connection.cursor.return_value = mock_cursor
 
-    with patch('main.connection', mock_connection):
+    with patch('main.pool', mock_db_pool):
         response = test_client.get(f"/profile/{email}")
         
     assert response.json()['status_code'] == 404
     assert response.json()['detail'] == "User not found"
     
     
-def test_get_users_by_interest(test_client, mock_db_connection):
+def test_get_users_batch(test_client, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+    user_id = str(uuid4())
+    missing_user_id = str(uuid4())
+
+    user_profile = {
+        "user_id": user_id,
+        "username": "test_user",
+        "email": "found@example.com",
+        "locality": "Aveiro",
+        "first_name": "John",
+        "last_name": "Doe",
+        "description": "User description",
+        "interests": [],
+        "image": ["https://bucket.s3.amazonaws.com/image.png"]
+    }
+    mock_cursor.fetchall.return_value = [user_profile]
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.post("/profile/batch", json={
+            "emails": ["found@example.com", "missing@example.com"],
+            "user_ids": [missing_user_id],
+        })
+
+    assert response.status_code == 200
+    assert response.json() == {
+        "profiles": [user_profile],
+        "missing": {"emails": ["missing@example.com"], "user_ids": [missing_user_id]},
+    }
+    mock_cursor.execute.assert_awaited_once()
+
+
+def test_get_users_batch_too_large(test_client, mock_db_pool):
+    emails = [f"user{i}@example.com" for i in range(3)]
+
+    with patch('main.pool', mock_db_pool), patch('main.PROFILE_BATCH_MAX_SIZE', 2):
+        response = test_client.post("/profile/batch", json={"emails": emails})
+
+    assert response.json()['status_code'] == 400
+    mock_db_pool.connection.assert_not_called()
+
+
+def test_get_users_by_interest(test_client, mock_db_connection, mock_db_pool):
     mock_connection, mock_cursor = mock_db_connection
 
     interest = "Dogs"
@@ -218,14 +759,107 @@ def test_get_users_by_interest(test_client, mock_db_connection):
     mock_cursor.fetchall.return_value = mock_data
     mock_connection.cursor.return_value = mock_cursor
 
-    with patch('main.connection', mock_connection):
+    with patch('main.pool', mock_db_pool):
         response = test_client.get(f"/profile/users/{interest}")
 
     assert response.status_code == 200
     assert response.json() == ["user1@example.com", "user2@example.com"]
     
 
-def test_get_users_by_interest_internal_server_error(test_client, mock_db_connection):
+def test_get_users_by_interest_paginates(test_client, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+
+    mock_data = [("user1@example.com",), ("user2@example.com",), ("user3@example.com",)]
+
+    mock_cursor.fetchall.return_value = mock_data
+    mock_connection.cursor.return_value = mock_cursor
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.get("/profile/users/Dogs", params={"limit": 2, "after": "user0@example.com"})
+
+    assert response.json() == ["user1@example.com", "user2@example.com"]
+    assert response.headers["X-Next-Cursor"] == "user2@example.com"
+
+    query, params = mock_cursor.execute.call_args[0]
+    assert "email > %s" in query
+    assert [json.loads(params[0]), *params[1:]] == [[{"interest": "Dogs"}], "user0@example.com", 3]
+
+
+@pytest.mark.parametrize("match, expected_params", [
+    ("any", [[{"interest": "Dogs"}], [{"interest": "Cats"}], 51]),
+    ("all", [[{"interest": "Dogs"}, {"interest": "Cats"}], 51]),
+])
+def test_get_users_by_several_interests(test_client, match, expected_params, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+
+    mock_cursor.fetchall.return_value = [("user1@example.com",)]
+    mock_connection.cursor.return_value = mock_cursor
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.get("/profile/users/Dogs,Cats", params={"match": match})
+
+    assert response.json() == ["user1@example.com"]
+    assert "X-Next-Cursor" not in response.headers
+    params = mock_cursor.execute.call_args[0][1]
+    assert [json.loads(param) for param in params[:-1]] + params[-1:] == expected_params
+
+
+@pytest.mark.parametrize("params, expected_query_params", [
+    ({}, (10,)),
+    ({"locality": "Aveiro", "limit": 3}, ("Aveiro", 3)),
+])
+def test_get_top_interests(test_client, params, expected_query_params, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+
+    mock_cursor.fetchall.return_value = [("Dogs", 12), ("Cats", 7)]
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.get("/profile/interests/top", params=params)
+
+    assert response.json() == [{"interest": "Dogs", "count": 12}, {"interest": "Cats", "count": 7}]
+    assert mock_cursor.execute.call_args[0][1] == expected_query_params
+
+
+def test_sync_user_interests_only_writes_the_difference(mock_db_connection):
+    mock_connection, mock_cursor = mock_db_connection
+    user_id = str(uuid4())
+
+    # Stored interests are ids 1 and 2, the new names resolve to ids 2 and 3
+    mock_cursor.fetchall.side_effect = [[(1,), (2,)], [(2,), (3,)]]
+
+    asyncio.run(sync_user_interests(mock_connection, user_id, "Aveiro", "Aveiro", ["Cats", "Birds", "Cats", ""]))
+
+    executed = [(" ".join(call[0][0].split()), call[0][1]) for call in mock_cursor.execute.call_args_list]
+    params_for = lambda prefix: next(params for query, params in executed if query.startswith(prefix))
+
+    assert params_for("INSERT INTO interests") == (["Cats", "Birds"],)
+    assert params_for("DELETE FROM user_interests") == (user_id, [1])
+    assert params_for("INSERT INTO user_interests") == (user_id, [3])
+    assert params_for("UPDATE interests") == ([1, 3], [-1, 1])
+
+    locality_params = mock_cursor.execute.call_args_list[-1][0][1]
+    assert locality_params == (["Aveiro", "Aveiro"], [1, 3], [-1, 1])
+
+
+@pytest.mark.parametrize("accept_encoding, expected_encoding", [
+    ("br", "br"),
+    ("gzip", "gzip"),
+    ("identity", None),
+])
+def test_large_responses_are_compressed(test_client, accept_encoding, expected_encoding, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+
+    emails = [f"user{i}@example.com" for i in range(200)]
+    mock_cursor.fetchall.return_value = [(email,) for email in emails]
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.get("/profile/users/Dogs", params={"limit": 500}, headers={"Accept-Encoding": accept_encoding})
+
+    assert response.headers.get("Content-Encoding") == expected_encoding
+    assert response.json() == emails
+
+
+def test_get_users_by_interest_internal_server_error(test_client, mock_db_connection, mock_db_pool):
     mock_connection, mock_cursor = mock_db_connection
 
     interest = "Cat"
@@ -234,11 +868,495 @@ def test_get_users_by_interest_internal_server_error(test_client, mock_db_connec
     mock_cursor.execute.side_effect = Exception("Simulated database error")
     mock_connection.cursor.return_value = mock_cursor
 
-    with patch('main.connection', mock_connection):
+    with patch('main.pool', mock_db_pool):
         response = test_client.get(f"/profile/users/{interest}")
         
     print(response.status_code)
     print(response.json())
 
     assert response.json()['status_code'] == 500
-    assert response.json()['detail'] == "Internal Server Error"
\ No newline at end of file
+    assert response.json()['detail'] == "Internal Server Error"
+
+def test_read_pool_routing(mock_db_pool):
+    replica_pool = MagicMock()
+
+    with patch('main.pool', mock_db_pool), patch('main.primary_pins', {}):
+        # No replica in rotation, reads go to the primary
+        with patch('main.healthy_replica_pools', []):
+            assert get_read_pool(["john@example.com"]) is mock_db_pool
+
+        with patch('main.healthy_replica_pools', [replica_pool]):
+            assert get_read_pool(["john@example.com"]) is replica_pool
+
+            # A profile that was just written is read back from the primary
+            user_id = uuid4()
+            pin_to_primary("john@example.com", user_id)
+            assert get_read_pool(["john@example.com"]) is mock_db_pool
+            assert get_read_pool(["jane@example.com"]) is replica_pool
+            # Also when it's looked up by user_id
+            assert get_read_pool([user_id]) is mock_db_pool
+            assert get_read_pool([uuid4()]) is replica_pool
+
+
+def test_batch_by_user_id_reads_pinned_profiles_from_primary(test_client, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.fetchall.return_value = []
+    replica_pool = MagicMock()
+    user_id = uuid4()
+
+    with patch('main.pool', mock_db_pool), patch('main.primary_pins', {}), patch('main.healthy_replica_pools', [replica_pool]):
+        pin_to_primary("john@example.com", user_id)
+        test_client.post("/profile/batch", json={"user_ids": [str(user_id)]})
+
+    mock_db_pool.connection.assert_called_once()
+    replica_pool.connection.assert_not_called()
+
+
+@pytest.mark.parametrize("lag, expected_healthy", [
+    (0.0, True),
+    (60.0, False),
+    (Exception("Simulated replica down"), False),
+])
+def test_check_replica_rotation(lag, expected_healthy, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+    if isinstance(lag, Exception):
+        mock_cursor.execute.side_effect = lag
+    else:
+        mock_cursor.fetchone.return_value = (lag,)
+
+    # Starts in rotation, so a lagging or unreachable replica is taken out of it
+    healthy_replica_pools = [mock_db_pool] if not expected_healthy else []
+    with patch('main.healthy_replica_pools', healthy_replica_pools):
+        assert asyncio.run(check_replica(mock_db_pool, "0/3000060")) is expected_healthy
+        assert (mock_db_pool in healthy_replica_pools) is expected_healthy
+
+
+def test_replica_lag_is_measured_against_the_primary(mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.fetchone.side_effect = [("0/3000060",), (0.0,)]
+    sleep = AsyncMock(side_effect=asyncio.CancelledError)
+
+    with patch('main.pool', mock_db_pool), patch('main.replica_pools', [mock_db_pool]), \
+            patch('main.healthy_replica_pools', []), patch('main.asyncio.sleep', sleep):
+        with pytest.raises(asyncio.CancelledError):
+            asyncio.run(main.monitor_replicas())
+
+    (lsn_query,), (lag_query, lag_params) = [call[0] for call in mock_cursor.execute.call_args_list]
+    assert "pg_current_wal_lsn()" in lsn_query
+    # A replica that isn't receiving WAL has no lag to report
+    assert "pg_stat_wal_receiver" in lag_query
+    assert lag_params == ("0/3000060",)
+
+
+def test_metrics(test_client, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.fetchone.return_value = None
+    mock_db_pool.name = "primary"
+    mock_db_pool.get_stats.return_value = {"pool_max": 10, "pool_size": 4, "pool_available": 1, "requests_waiting": 2}
+
+    with patch('main.pool', mock_db_pool):
+        test_client.get("/profile/nonexistent@gmail.com")
+        response = test_client.get("/metrics")
+
+    assert response.status_code == 200
+    metrics = response.text
+    # Labelled by route template, not by email
+    assert 'http_request_duration_seconds_count{method="GET",route="/profile/{email}",status="200"}' in metrics
+    assert "nonexistent@gmail.com" not in metrics
+    assert 'profile_stage_duration_seconds_count{name="select_profile",stage="db"}' in metrics
+    assert 'db_requests_waiting{pool="primary"} 2.0' in metrics
+    assert "profile_cache_hit_ratio" in metrics
+
+
+def test_slow_query_is_logged(test_client, mock_db_connection, mock_db_pool, caplog):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.fetchone.return_value = None
+
+    with patch('main.pool', mock_db_pool), patch('main.SLOW_QUERY_THRESHOLD_MS', 0.000001):
+        test_client.get("/profile/nonexistent@gmail.com")
+
+    assert "Slow query select_profile" in caplog.text
+
+
+def test_ready(test_client):
+    with patch('main.db_ready', False):
+        response = test_client.get("/ready")
+    assert response.status_code == 503
+
+    with patch('main.db_ready', True):
+        response = test_client.get("/ready")
+    assert response.status_code == 200
+
+
+def test_migrate_applies_only_pending_migrations(mock_db_connection):
+    mock_connection, mock_cursor = mock_db_connection
+    applied = [(version,) for version, _, _ in MIGRATIONS[:-1]]
+    mock_cursor.fetchall.return_value = applied
+
+    asyncio.run(migrate(mock_connection))
+
+    last_version, last_name, _ = MIGRATIONS[-1]
+    recorded = [call[0][1] for call in mock_cursor.execute.call_args_list if "INSERT INTO schema_migrations" in call[0][0]]
+    assert recorded == [(last_version, last_name)]
+    mock_connection.commit.assert_awaited_once()
+
+
+@pytest.mark.parametrize("max_connections, workers, expected_pool_max_size", [
+    (100, 1, 99),
+    (100, 4, 24),
+    (90, 8, 10),
+    (4, 8, 1),
+])
+def test_worker_pool_max_size(max_connections, workers, expected_pool_max_size):
+    # Every worker's pool plus its LISTEN connection fits in the budget
+    assert main.worker_pool_max_size(max_connections, workers) == expected_pool_max_size
+    assert workers * (expected_pool_max_size + 1) <= max(max_connections, workers * 2)
+
+
+def test_lifespan_opens_and_closes_the_worker_state(mock_db_pool):
+    start_db = AsyncMock()
+    with patch('main.start_db', start_db), patch('main.pool', mock_db_pool), patch('main.replica_pools', []):
+        with TestClient(app) as client:
+            assert client.get("/health/").json()["status_code"] == 200
+        start_db.assert_awaited_once()
+        mock_db_pool.close.assert_awaited_once()
+
+
+def test_start_db_retries_with_backoff():
+    sleep = AsyncMock()
+    with patch('main.connect_db', AsyncMock(side_effect=[False, False, True])), \
+            patch('main.asyncio.sleep', sleep), \
+            patch('main.listen_for_profile_changes', AsyncMock()), \
+            patch('main.prune_profile_changes', AsyncMock()), \
+            patch('main.follow_profile_changes', AsyncMock()), \
+            patch('main.db_ready', False):
+        asyncio.run(start_db())
+        assert main.db_ready is True
+
+    delays = [call[0][0] for call in sleep.await_args_list]
+    assert len(delays) == 2
+    # Jittered, but each wait is drawn from a doubled range
+    assert delays[0] <= delays[1]
+
+
+def outbox_writes(mock_cursor):
+    return [call[0] for call in mock_cursor.execute.call_args_list if "INSERT INTO profile_changes" in call[0][0]]
+
+
+def change_row(change_id, txid, email):
+    return {
+        "change_id": change_id,
+        "txid": str(txid),
+        "user_id": uuid4(),
+        "email": email,
+        "operation": "updated",
+        "changed_at": datetime(2024, 1, 1, tzinfo=timezone.utc),
+    }
+
+
+def test_change_cursor_round_trip():
+    assert decode_change_cursor(encode_change_cursor(754, 12)) == (754, 12)
+    assert decode_change_cursor(None) == (0, 0)
+
+
+def test_profile_writes_are_recorded_in_outbox(test_client, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+    user_id = uuid4()
+
+    mock_cursor.fetchone.return_value = (user_id,)
+    with patch('main.pool', mock_db_pool):
+        test_client.post("/profile/", data={"username": "TestUser", "email": "testuser@gmail.com"})
+    query, params = outbox_writes(mock_cursor)[0]
+    assert "pg_notify" in query
+    assert params[:3] == (user_id, "testuser@gmail.com", "created")
+    # Other workers pin the profile by both keys
+    assert params[-2:] == ("testuser@gmail.com", user_id)
+
+    mock_cursor.reset_mock()
+    mock_cursor.fetchone.return_value = {"user_id": user_id, "previous_locality": None}
+    mock_cursor.fetchall.return_value = []
+    with patch('main.pool', mock_db_pool):
+        test_client.put("/profile/testuser@gmail.com", data={"interests": "Dogs"})
+    query, params = outbox_writes(mock_cursor)[0]
+    assert params[:3] == (str(user_id), "testuser@gmail.com", "updated")
+
+
+def test_import_records_changes_and_notifies_once(test_client, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.copy = MagicMock()
+    mock_cursor.copy.return_value.__aenter__.return_value = AsyncMock()
+    mock_cursor.fetchall.return_value = []
+
+    with patch('main.pool', mock_db_pool):
+        test_client.post("/profile/import", files={"file": ("profiles.csv", b"username,email\nuser1,user1@example.com\nuser2,user2@example.com\n")})
+
+    queries = [call[0][0] for call in mock_cursor.execute.call_args_list]
+    assert any("INSERT INTO profile_changes" in query for query in queries)
+    assert sum("pg_notify" in query for query in queries) == 1
+
+
+def test_get_profile_changes(test_client, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.fetchall.return_value = [change_row(7, 900, "a@example.com"), change_row(5, 901, "b@example.com")]
+    mock_cursor.fetchone.return_value = (False,)
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.get("/profile/changes", params={"since": "899-3", "limit": 2})
+
+    changes = response.json()
+    assert [change["cursor"] for change in changes] == ["900-7", "901-5"]
+    assert changes[0]["email"] == "a@example.com"
+    assert response.headers["X-Next-Cursor"] == "901-5"
+
+    query, params = mock_cursor.execute.call_args[0]
+    # Only changes of transactions that finished before every running one
+    assert "txid < pg_snapshot_xmin(pg_current_snapshot())" in query
+    assert "ORDER BY txid, change_id" in query
+    assert params == (899, 3, 2)
+    # The snapshot read doesn't leave the pooled connection in a transaction
+    mock_connection.commit.assert_awaited_once()
+
+
+def test_get_profile_changes_empty_page_keeps_cursor(test_client, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.fetchall.return_value = []
+    mock_cursor.fetchone.return_value = (False,)
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.get("/profile/changes", params={"since": "899-3"})
+
+    assert response.json() == []
+    assert response.headers["X-Next-Cursor"] == "899-3"
+
+
+@pytest.mark.parametrize("path", ["/profile/changes", "/profile/changes/stream"])
+def test_profile_changes_cursor_behind_retention(test_client, path, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.fetchone.return_value = (True,)
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.get(path, params={"since": "899-3"})
+
+    assert response.json()["status_code"] == 410
+    query, params = mock_cursor.execute.call_args[0]
+    assert "profile_changes_horizon" in query
+    assert params == (899, 3)
+
+
+@pytest.mark.parametrize("since", ["abc", "12-x", "-"])
+def test_get_profile_changes_invalid_cursor(test_client, since, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.get("/profile/changes", params={"since": since})
+
+    assert response.json()["status_code"] == 400
+    mock_cursor.execute.assert_not_awaited()
+
+
+def test_profile_change_events(mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.fetchall.side_effect = [[change_row(7, 900, "a@example.com")], []]
+
+    async def first_events(count):
+        events = profile_change_events((899, 3))
+        received = [await events.__anext__() for _ in range(count)]
+        await events.aclose()
+        return received
+
+    with patch('main.pool', mock_db_pool), patch('main.PROFILE_CHANGES_STREAM_POLL_INTERVAL', 0.01):
+        event, keepalive, _ = asyncio.run(first_events(3))
+
+    lines = event.split("\n")
+    assert lines[0] == "id: 900-7"
+    assert lines[1] == "event: profile_change"
+    assert json.loads(lines[2][len("data: "):])["email"] == "a@example.com"
+    assert event.endswith("\n\n")
+    assert keepalive == ": keepalive\n\n"
+    # The second read continues after the change already sent
+    assert mock_cursor.execute.call_args_list[1][0][1][:2] == (900, 7)
+    assert not main.profile_change_waiters
+
+
+def test_change_streams_share_one_reader(mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+    # The reader starts its tail at the newest change, then reads what's new
+    mock_cursor.fetchone.return_value = ("899", 3)
+    mock_cursor.fetchall.return_value = [change_row(7, 900, "a@example.com")]
+    tail = main.ProfileChangeTail(10)
+
+    async def follow_then_stream():
+        main.profile_changes_notified = asyncio.Event()
+        follower = asyncio.create_task(main.follow_profile_changes())
+        while not tail.changes:
+            await asyncio.sleep(0)
+        streams = [profile_change_events((899, 3)) for _ in range(3)]
+        events = [await stream.__anext__() for stream in streams]
+        follower.cancel()
+        for stream in streams:
+            await stream.aclose()
+        return events
+
+    with patch('main.pool', mock_db_pool), patch('main.profile_change_tail', tail):
+        events = asyncio.run(follow_then_stream())
+
+    assert all(event.startswith("id: 900-7\n") for event in events)
+    # One read of the outbox for all three streams
+    assert len(mock_cursor.fetchall.call_args_list) == 1
+    assert tail.after((0, 0)) is None
+    assert tail.after((900, 7)) == []
+
+
+def test_stream_profile_changes_resumes_from_last_event_id(test_client, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.fetchone.return_value = (False,)
+    positions = []
+
+    async def fake_events(position):
+        positions.append(position)
+        yield "id: 900-7\n\n"
+
+    with patch('main.pool', mock_db_pool), patch('main.profile_change_events', fake_events):
+        response = test_client.get("/profile/changes/stream", params={"since": "1-1"}, headers={"Last-Event-ID": "899-3"})
+
+    assert response.headers["content-type"].startswith("text/event-stream")
+    # Not held back by the compression middleware
+    assert "content-encoding" not in response.headers
+    assert positions == [(899, 3)]
+
+
+@pytest.mark.parametrize("user", [None, ("{user_id}",)])
+def test_confirm_image_upload_never_touches_other_objects(test_client, user, mock_db_connection, mock_db_pool, mock_s3):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.fetchone.return_value = (str(uuid4()),) if user else None
+    mock_s3.put_object(Bucket="test-bucket", Key="backups/other-service.tar", Body=b"data", ContentType="application/x-tar")
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.post("/profile/testuser@gmail.com/image/confirm", data={"key": "backups/other-service.tar"})
+
+    assert response.json()["status_code"] == (403 if user else 404)
+    assert mock_s3.head_object(Bucket="test-bucket", Key="backups/other-service.tar")["ContentLength"] == 4
+
+
+def test_reads_return_connection_idle(test_client, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.fetchone.return_value = None
+    mock_cursor.fetchall.return_value = []
+
+    with patch('main.pool', mock_db_pool):
+        test_client.get("/profile/nonexistent@gmail.com")
+        test_client.get("/profile/users/Dogs")
+
+    # Queried in autocommit, so nothing is left open for the pool to roll back
+    assert [call[0][0] for call in mock_connection.set_autocommit.await_args_list] == [True, False, True, False]
+    mock_connection.rollback.assert_not_awaited()
+
+
+def test_import_lifts_pool_statement_timeout(test_client, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.copy = MagicMock()
+    mock_cursor.copy.return_value.__aenter__.return_value = AsyncMock()
+    mock_cursor.fetchall.return_value = []
+
+    with patch('main.pool', mock_db_pool):
+        test_client.post("/profile/import", files={"file": ("profiles.csv", b"username,email\nuser1,user1@example.com\n")})
+
+    query, params = mock_cursor.execute.call_args_list[0][0]
+    assert "set_config('statement_timeout', %s, true)" in query
+    assert params == ("0",)
+
+
+@pytest.mark.parametrize("method, url, body", [
+    ("get", "/profile/testuser@gmail.com", None),
+    ("post", "/profile/batch", {"emails": ["testuser@gmail.com"]}),
+    ("get", "/profile/export", None),
+    ("get", "/profile/users/Dogs", None),
+])
+def test_endpoints_unavailable_until_db_ready(test_client, method, url, body):
+    with patch('main.pool', None):
+        response = test_client.request(method, url, json=body)
+
+    assert response.status_code == 503
+    assert response.json()["detail"] == "Database not ready"
+
+
+def patched_row(user_id, interests=None, locality="Aveiro"):
+    return {
+        "found": True,
+        "user_id": user_id,
+        "locality": locality,
+        "interests": interests or [],
+        "updated_at": datetime(2024, 1, 2, tzinfo=timezone.utc),
+        "previous_locality": locality,
+    }
+
+
+def test_patch_profile_writes_only_supplied_fields(test_client, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+    user_id = uuid4()
+    mock_cursor.fetchone.return_value = patched_row(user_id)
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.patch("/profile/testuser@gmail.com", json={"first_name": "John", "description": None})
+
+    assert response.json()["message"] == "User Profile updated successfully!"
+    assert response.headers["ETag"] == profile_etag(datetime(2024, 1, 2, tzinfo=timezone.utc))
+
+    query, params = mock_cursor.execute.call_args_list[0][0]
+    set_clause = query.split("SET", 1)[1].split("FROM previous", 1)[0]
+    assert "first_name = %s" in set_clause and "description = %s" in set_clause
+    assert "locality" not in set_clause and "interests" not in set_clause
+    assert params == ("testuser@gmail.com", "John", None, None, None)
+    # Interests weren't touched, so neither are the interest tables
+    assert len(outbox_writes(mock_cursor)) == 1
+    assert len(mock_cursor.execute.call_args_list) == 2
+    mock_connection.commit.assert_awaited_once()
+
+
+def test_patch_profile_adds_and_removes_interests(test_client, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.fetchone.return_value = patched_row(uuid4(), [{"interest": "Dogs"}, {"interest": "Birds"}])
+    mock_cursor.fetchall.return_value = []
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.patch("/profile/testuser@gmail.com", json={"add_interests": ["Birds", " Birds", "Cats"], "remove_interests": ["Cats", "Fish"]})
+
+    assert response.json()["message"] == "User Profile updated successfully!"
+    query, params = mock_cursor.execute.call_args_list[0][0]
+    assert "jsonb_array_elements(COALESCE(p.interests, '[]'::jsonb))" in query
+    # Removed names win over added ones
+    assert params == ("testuser@gmail.com", ["Cats", "Fish"], ["Birds"], None, None)
+    # The normalized interests are synced to the merged set
+    assert any("user_interests" in call[0][0] for call in mock_cursor.execute.call_args_list[1:])
+
+
+def test_patch_profile_if_match(test_client, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+    version = datetime(2024, 1, 1, 12, 30, 15, 123457, tzinfo=timezone.utc)
+    assert etag_version(profile_etag(version)) == version
+
+    mock_cursor.fetchone.return_value = {"found": True, "user_id": None}
+    with patch('main.pool', mock_db_pool):
+        response = test_client.patch("/profile/testuser@gmail.com", json={"locality": "Porto"}, headers={"If-Match": profile_etag(version)})
+
+    assert response.json()["status_code"] == 412
+    params = mock_cursor.execute.call_args[0][1]
+    assert params[-2:] == (version, version)
+    mock_connection.commit.assert_not_awaited()
+
+
+@pytest.mark.parametrize("body, headers, row, expected_status_code", [
+    ({}, {}, None, 400),
+    ({"interests": ["Dogs"], "add_interests": ["Cats"]}, {}, None, 400),
+    ({"locality": "Porto"}, {"If-Match": '"not-a-version"'}, None, 412),
+    ({"locality": "Porto"}, {}, {"found": False, "user_id": None}, 404),
+])
+def test_patch_profile_rejected(test_client, body, headers, row, expected_status_code, mock_db_connection, mock_db_pool):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_cursor.fetchone.return_value = row
+
+    with patch('main.pool', mock_db_pool):
+        response = test_client.patch("/profile/testuser@gmail.com", json=body, headers=headers)
+
+    assert response.json()["status_code"] == expected_status_code
+    mock_connection.commit.assert_not_awaited()